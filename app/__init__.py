@@ -1,6 +1,7 @@
 import os
 import shutil
 import datetime
+import itertools
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -15,8 +16,10 @@ from pathlib import Path
 from apscheduler.schedulers.background import BackgroundScheduler
 
 from config import *
-from .db import Base, Page, PageState, Request, Notification, ApiKey, Engine
-from app.mail.mail import send_mail
+from .db import Base, Page, PageState, Request, ApiKey, Engine
+from app.mail.notifications import notification_queue
+from app.waiting_pages import waiting_pages_notifier
+from app.metrics import init_metrics
 
 
 engine = create_engine(database_url, convert_unicode=True)
@@ -27,7 +30,10 @@ def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
 
-    db_session = init_db(app)
+    init_db(app)
+    init_metrics(app, engine)
+    waiting_pages_notifier.start(engine)
+    notification_queue.start(app.config, session_factory)
 
     scheduler = BackgroundScheduler()
     scheduler.start()
@@ -36,20 +42,12 @@ def create_app():
 
     Path(app.config['PROCESSED_REQUESTS_FOLDER']).mkdir(parents=True, exist_ok=True)
     Path(app.config['MODELS_FOLDER']).mkdir(parents=True, exist_ok=True)
+    Path(app.config['ENGINE_BUNDLES_FOLDER']).mkdir(parents=True, exist_ok=True)
     Path(app.config['UPLOAD_IMAGES_FOLDER']).mkdir(parents=True, exist_ok=True)
 
     Bootstrap(app)
     Dropzone(app)
 
-    notification = db_session.query(Notification).first()
-    if notification is not None:
-        notification.last_notification = datetime.datetime(1970, 1, 1)
-    else:
-        notification = Notification(datetime.datetime(1970, 1, 1))
-        db_session.add(notification)
-
-    db_session.commit()
-
     jsglue = JSGlue()
     jsglue.init_app(app)
 
@@ -72,46 +70,48 @@ def processing_timeout():
     db_session = session_factory()
     try:
         now = datetime.datetime.now()
-        delta = datetime.timedelta(seconds=60)
-        timestamp = now - delta
-    
-        pages = db_session.query(Page).filter(Page.state == PageState.PROCESSING).filter(Page.processing_timestamp < timestamp).all()
-        message_body = ""
-        for page in pages:
-            page.state = PageState.WAITING
-            page.processing_timestamp = None
-    
-            request = db_session.query(Request).filter(Request.id == page.request_id).first()
-            engine = db_session.query(Engine).filter(Engine.id == request.engine_id).first()
-            api_key = db_session.query(ApiKey).filter(ApiKey.id == request.api_key_id).first()
-    
-            message_body += "owner_api_key: {}<br>" \
-                            "owner_description: {}<br>" \
-                            "engine_id: {}<br>" \
-                            "engine_name: {}<br>" \
-                            "request_id: {}<br>" \
-                            "page_id: {}<br>" \
-                            "page_name: {}<br>" \
-                            "page_url: {}<br><br>" \
-                            "####################<br><br>" \
-                            .format(api_key.api_string,
-                                    api_key.owner,
-                                    engine.id,
-                                    engine.name,
-                                    request.id,
-                                    page.id,
-                                    page.name,
-                                    page.url)
-
-        if pages != [] and Config.EMAIL_NOTIFICATION_ADDRESSES != []:
-            send_mail(subject="API Bot - PROCESSING TIMEOUT",
-                      body=message_body,
-                      sender=('PERO OCR - API BOT', Config.MAIL_USERNAME),
-                      recipients=Config.EMAIL_NOTIFICATION_ADDRESSES,
-                      host=Config.MAIL_SERVER,
-                      password=Config.MAIL_PASSWORD)
 
-        db_session.commit()
+        # leases are renewed by processing clients, only pages without renewal for lease duration of engine expire
+        expired_requests = dict()
+        reset_page_count = 0
+        engines = db_session.query(Engine.id, Engine.name, Engine.lease_duration).all()
+        for engine_id, engine_name, lease_duration in engines:
+            if lease_duration is None:
+                lease_duration = Config.PAGE_LEASE_DURATION
+            timestamp = now - datetime.timedelta(seconds=lease_duration)
+
+            # expired pages are reset in batches by guarded UPDATEs, so the transactions stay short
+            while True:
+                pages = db_session.query(Page.id, Request.id, ApiKey.api_string, ApiKey.owner)\
+                                  .join(Request, Page.request_id == Request.id)\
+                                  .join(ApiKey, Request.api_key_id == ApiKey.id)\
+                                  .filter(Request.engine_id == engine_id)\
+                                  .filter(Page.state == PageState.PROCESSING)\
+                                  .filter(Page.processing_timestamp < timestamp)\
+                                  .limit(Config.REAPER_BATCH_SIZE)\
+                                  .all()
+                if not pages:
+                    break
+
+                reset_page_ids = reset_expired_pages(db_session, [page[0] for page in pages], timestamp)
+                db_session.commit()
+                reset_page_count += len(reset_page_ids)
+
+                # pages renewed or finished since they were selected are not reported
+                for page_id, request_id, api_string, owner in pages:
+                    if page_id in reset_page_ids:
+                        expired_request = expired_requests.setdefault(
+                            request_id, {'api_string': api_string, 'owner': owner, 'engine_id': engine_id,
+                                         'engine_name': engine_name, 'page_ids': []})
+                        expired_request['page_ids'].append(page_id)
+
+                if len(pages) < Config.REAPER_BATCH_SIZE:
+                    break
+
+        if reset_page_count:
+            waiting_pages_notifier.notify()
+            notification_queue.notify("API Bot - PROCESSING TIMEOUT",
+                                      get_processing_timeout_message(expired_requests, reset_page_count))
     except:
         db_session.rollback()
         raise
@@ -119,31 +119,97 @@ def processing_timeout():
         db_session.close()
 
 
+def reset_expired_pages(db_session, page_ids, timestamp):
+    """
+    Switches pages whose lease was not renewed since timestamp from PROCESSING back to WAITING. Has to be committed.
+    @return: set of IDs of pages which were reset
+    """
+    page_table = Page.__table__
+    update = page_table.update()\
+                       .where(page_table.c.state == PageState.PROCESSING)\
+                       .where(page_table.c.processing_timestamp < timestamp)\
+                       .values(state=PageState.WAITING, processing_timestamp=None,
+                               waiting_timestamp=datetime.datetime.utcnow())
+    if db_session.bind.dialect.name == 'postgresql':
+        rows = db_session.execute(update.where(page_table.c.id.in_(page_ids)).returning(page_table.c.id))
+        return {page_id for page_id, in rows}
+
+    # SQLite does not return updated rows, every page is reset by its own guarded UPDATE
+    reset_page_ids = set()
+    for page_id in page_ids:
+        if db_session.execute(update.where(page_table.c.id == page_id)).rowcount:
+            reset_page_ids.add(page_id)
+    return reset_page_ids
+
+
+def get_processing_timeout_message(expired_requests, page_count):
+    """
+    @return: summary of expired leases with page count and first page IDs of each request, the number of listed
+             requests is limited by MAX_NOTIFICATION_DIGEST_SIZE
+    """
+    message_body = f"{page_count} pages of {len(expired_requests)} requests were returned to processing.<br><br>"
+    for request_id, expired_request in itertools.islice(expired_requests.items(),
+                                                        Config.MAX_NOTIFICATION_DIGEST_SIZE):
+        page_ids = expired_request['page_ids']
+        listed_page_ids = ", ".join(str(page_id) for page_id in page_ids[:Config.MAX_NOTIFICATION_PAGES_PER_REQUEST])
+        if len(page_ids) > Config.MAX_NOTIFICATION_PAGES_PER_REQUEST:
+            listed_page_ids += ", ..."
+        message_body += "owner_api_key: {}<br>" \
+                        "owner_description: {}<br>" \
+                        "engine_id: {}<br>" \
+                        "engine_name: {}<br>" \
+                        "request_id: {}<br>" \
+                        "page_count: {}<br>" \
+                        "page_ids: {}<br><br>" \
+                        "####################<br><br>" \
+                        .format(expired_request['api_string'],
+                                expired_request['owner'],
+                                expired_request['engine_id'],
+                                expired_request['engine_name'],
+                                request_id,
+                                len(page_ids),
+                                listed_page_ids)
+
+    if len(expired_requests) > Config.MAX_NOTIFICATION_DIGEST_SIZE:
+        message_body += f"{len(expired_requests) - Config.MAX_NOTIFICATION_DIGEST_SIZE} more requests omitted.<br>"
+    return message_body
+
+
 def old_files_removals():
-    try: 
+    db_session = session_factory()
+    try:
         now = datetime.datetime.now()
         delta = datetime.timedelta(days=7)
         timestamp = now - delta
 
-        db_session = session_factory()
-        pages = db_session.query(Page).outerjoin(Request)\
-                          .filter(Request.finish_timestamp < timestamp) \
-                          .filter(Page.state == PageState.PROCESSED) \
-                          .all()
-        for page in pages:
-            page.state = PageState.EXPIRED
-
-        db_session.commit()
-
-        requests = db_session.query(Request).filter(Request.finish_timestamp < timestamp).all()
-
-        for request in requests:
-            requests_dir_path = os.path.join(Config.PROCESSED_REQUESTS_FOLDER, str(request.id))
-            images_dir_path = os.path.join(Config.UPLOAD_IMAGES_FOLDER, str(request.id))
+        # pages expire in batches, each batch is one UPDATE in its own short transaction
+        while True:
+            page_ids = [page_id for page_id, in db_session.query(Page.id).join(Request)
+                                                          .filter(Request.finish_timestamp < timestamp)
+                                                          .filter(Page.state == PageState.PROCESSED)
+                                                          .limit(Config.REAPER_BATCH_SIZE)
+                                                          .all()]
+            if not page_ids:
+                break
+
+            db_session.query(Page).filter(Page.id.in_(page_ids))\
+                                  .filter(Page.state == PageState.PROCESSED)\
+                                  .update({Page.state: PageState.EXPIRED}, synchronize_session=False)
+            db_session.commit()
+
+            if len(page_ids) < Config.REAPER_BATCH_SIZE:
+                break
+
+        request_ids = db_session.query(Request.id).filter(Request.finish_timestamp < timestamp)\
+                                                  .yield_per(Config.REAPER_BATCH_SIZE)
+        for request_id, in request_ids:
+            requests_dir_path = os.path.join(Config.PROCESSED_REQUESTS_FOLDER, str(request_id))
+            images_dir_path = os.path.join(Config.UPLOAD_IMAGES_FOLDER, str(request_id))
             if os.path.isdir(requests_dir_path):
                 shutil.rmtree(requests_dir_path)
             if os.path.isdir(images_dir_path):
                 shutil.rmtree(images_dir_path)
+        db_session.commit()
     except:
         db_session.rollback()
         raise
@@ -3,4 +3,4 @@ from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 
 from .model import PageState, Permission
-from .model import ApiKey, Request, Page, Engine, EngineVersion, Notification
+from .model import ApiKey, Request, Page, Engine, EngineVersion, Notification, QueuedNotification
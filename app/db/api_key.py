@@ -1,8 +1,13 @@
+import os
+import time
 import base64
 import random
 import hashlib
+import threading
+from pathlib import Path
 from functools import wraps
-from flask import request, abort
+from collections import OrderedDict, namedtuple
+from flask import request, abort, g, current_app
 
 from app.db import ApiKey
 from app.db import Permission
@@ -16,41 +21,103 @@ def generate_hash_key():
                             random.choice(['rA', 'aZ', 'gQ', 'hH', 'hG', 'aR', 'DD']).encode('utf-8')).decode('utf-8').rstrip('==')
 
 
-def get_apiauth_object_by_key_u(key):
+CachedApiKey = namedtuple('CachedApiKey', ['id', 'api_string', 'owner', 'permission', 'suspension',
+                                           'max_priority'])
+
+
+class ApiKeyCache(object):
+    """
+    LRU cache of resolved API keys with time to live. Processes changing API keys (scripts) invalidate it by touching
+    invalidation file, whose modification time is checked on every lookup.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.invalidation_mtime = None
+
+    def get(self, key, invalidation_file):
+        """
+        @return: tuple (found, CachedApiKey or None for nonexistent key)
+        """
+        invalidation_mtime = get_invalidation_mtime(invalidation_file)
+        with self.lock:
+            if invalidation_mtime != self.invalidation_mtime:
+                self.entries.clear()
+                self.invalidation_mtime = invalidation_mtime
+
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            expiration, api_key = entry
+            if expiration < time.time():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, api_key
+
+    def put(self, key, api_key, ttl, max_size):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, api_key)
+            self.entries.move_to_end(key)
+            while len(self.entries) > max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+api_key_cache = ApiKeyCache()
+
+
+def get_invalidation_mtime(invalidation_file):
+    try:
+        return os.stat(invalidation_file).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def invalidate_api_key_cache(invalidation_file):
     """
-    Query the datastorage for an API key.
-    @return: apiauth sqlachemy object.
+    Invalidates API key caches of all server processes, has to be called after API keys are changed.
     """
-    api_string = ApiKey.query.filter(ApiKey.api_string == key).first()
-    return api_string
+    api_key_cache.clear()
+    Path(invalidation_file).touch()
+    os.utime(invalidation_file)
 
 
-def get_apiauth_object_by_key_su(key):
+def get_api_key(key):
     """
-    Query the datastorage for an API key.
-    @return: apiauth sqlachemy object.
+    Query the cache or the datastorage for an API key.
+    @return: CachedApiKey or None
     """
-    api_string = ApiKey.query.filter(ApiKey.api_string == key).filter(ApiKey.permission == Permission.SUPER_USER).first()
-    return api_string
+    found, api_key = api_key_cache.get(key, current_app.config['API_KEY_CACHE_INVALIDATION_FILE'])
+    if not found:
+        api_key = ApiKey.query.filter(ApiKey.api_string == key).first()
+        if api_key is not None:
+            api_key = CachedApiKey(api_key.id, api_key.api_string, api_key.owner, api_key.permission,
+                                   api_key.suspension, api_key.max_priority)
+        api_key_cache.put(key, api_key, current_app.config['API_KEY_CACHE_TTL'],
+                          current_app.config['API_KEY_CACHE_SIZE'])
+    return api_key
 
 
 def match_api_keys(key, permission):
     """
     Match API keys
     @param key: API key from request
-    @return: boolean
+    @return: CachedApiKey or None
     """
     if key is None:
-        return False
-
-    if permission == Permission.USER:
-        api_key = get_apiauth_object_by_key_u(key)
-    elif permission == Permission.SUPER_USER:
-        api_key = get_apiauth_object_by_key_su(key)
+        return None
 
-    if api_key is not None:
-        return True
-    return False
+    api_key = get_api_key(key)
+    if api_key is None:
+        return None
+    if permission == Permission.SUPER_USER and api_key.permission != Permission.SUPER_USER:
+        return None
+    return api_key
 
 
 def require_super_user_api_key(f):
@@ -61,7 +128,8 @@ def require_super_user_api_key(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         api_string = request.headers.get('api-key')
-        if match_api_keys(api_string, Permission.SUPER_USER):
+        g.api_key = match_api_keys(api_string, Permission.SUPER_USER)
+        if g.api_key is not None:
             return f(*args, **kwargs)
         else:
             abort(401, f'API key {api_string} either does not exist or does not have necessary permissions.')
@@ -76,7 +144,8 @@ def require_user_api_key(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         api_string = request.headers.get('api-key')
-        if match_api_keys(api_string, Permission.USER):
+        g.api_key = match_api_keys(api_string, Permission.USER)
+        if g.api_key is not None:
             return f(*args, **kwargs)
         else:
             abort(401, f'API key {api_string} either does not exist or does not have necessary permissions.')
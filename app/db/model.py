@@ -4,7 +4,7 @@ import datetime
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship
-from sqlalchemy import Column, Enum, ForeignKey, Integer, String, DateTime, Float, Boolean
+from sqlalchemy import Column, Enum, ForeignKey, Integer, String, DateTime, Float, Boolean, Index, text
 from app.db import Base
 
 from app.db.guid import GUID
@@ -22,6 +22,11 @@ class PageState(enum.Enum):
     EXPIRED = 'Page expired.'
 
 
+UNFINISHED_PAGE_STATES = [PageState.CREATED, PageState.WAITING, PageState.PROCESSING]
+PROCESSED_PAGE_STATES = [PageState.PROCESSED, PageState.EXPIRED]
+FAILED_PAGE_STATES = [PageState.NOT_FOUND, PageState.INVALID_FILE, PageState.PROCESSING_FAILED]
+
+
 class Permission(enum.Enum):
     SUPER_USER = 'User can take and process requests.'
     USER = 'User can create requests.'
@@ -34,11 +39,14 @@ class ApiKey(Base):
     owner = Column(String(), nullable=False)
     permission = Column(Enum(Permission), nullable=False)
     suspension = Column(Boolean(), nullable=False, default=False)
+    # the highest priority requests of the key can get, set by administrator
+    max_priority = Column(Integer(), nullable=False, default=0, server_default='0')
 
-    def __init__(self, api_string, owner, permission):
+    def __init__(self, api_string, owner, permission, max_priority=0):
         self.api_string = api_string
         self.owner = owner
         self.permission = permission
+        self.max_priority = max_priority
 
 
 class Request(Base):
@@ -48,8 +56,21 @@ class Request(Base):
     modification_timestamp = Column(DateTime(), nullable=False, index=True, default=datetime.datetime.utcnow)
     finish_timestamp = Column(DateTime(), nullable=True, index=True)
 
-    engine_id = Column(Integer(), ForeignKey('engine.id'), nullable=False)
-    api_key_id = Column(Integer(), ForeignKey('api_key.id'), nullable=False)
+    # counters of pages by state, maintained together with page state changes
+    page_count = Column(Integer(), nullable=False, default=0, server_default='0')
+    finished_page_count = Column(Integer(), nullable=False, default=0, server_default='0')
+    processed_page_count = Column(Integer(), nullable=False, default=0, server_default='0')
+    failed_page_count = Column(Integer(), nullable=False, default=0, server_default='0')
+    score_sum = Column(Float(), nullable=False, default=0, server_default='0')
+    priority = Column(Integer(), nullable=False, index=True, default=0, server_default='0')
+
+    engine_id = Column(Integer(), ForeignKey('engine.id'), nullable=False, index=True)
+    api_key_id = Column(Integer(), ForeignKey('api_key.id'), nullable=False, index=True)
+
+    __table_args__ = (
+        # dispatch picks requests of engine by priority and age
+        Index('ix_request_engine_id_priority_creation_timestamp', 'engine_id', 'priority', 'creation_timestamp'),
+    )
 
     def __init__(self, engine_id, api_key_id):
         self.engine_id = engine_id
@@ -66,10 +87,23 @@ class Page(Base):
     traceback = Column(String(), nullable=True)
     processing_timestamp = Column(DateTime(), nullable=True)
     finish_timestamp = Column(DateTime(), nullable=True, index=True)
+    # UTC time when page last became WAITING, dispatch measures how long engine starves from it
+    waiting_timestamp = Column(DateTime(), nullable=True)
 
     request_id = Column(GUID(), ForeignKey('request.id'), nullable=False, index=True)
     engine_version = Column(Integer(), ForeignKey('engine_version.id'), nullable=True, index=True)
 
+    __table_args__ = (
+        # upload_image and upload_results look pages up by request and name
+        Index('ix_page_request_id_name', 'request_id', 'name', unique=True),
+        # dispatch only touches the small set of waiting pages
+        Index('ix_page_waiting_request_id', 'request_id',
+              postgresql_where=text("state = 'WAITING'"), sqlite_where=text("state = 'WAITING'")),
+        # reaper only touches pages in processing
+        Index('ix_page_processing_processing_timestamp', 'processing_timestamp',
+              postgresql_where=text("state = 'PROCESSING'"), sqlite_where=text("state = 'PROCESSING'")),
+    )
+
     def __init__(self, name, url, state, request_id):
         self.name = name
         self.url = url
@@ -82,10 +116,13 @@ class Engine(Base):
     id = Column(Integer(), primary_key=True)
     name = Column(String(), nullable=False)
     description = Column(String(), nullable=True)
+    # seconds for which page stays leased to processing client without renewal, PAGE_LEASE_DURATION when not set
+    lease_duration = Column(Integer(), nullable=True)
 
-    def __init__(self, name, description):
+    def __init__(self, name, description, lease_duration=None):
         self.name = name
         self.description = description
+        self.lease_duration = lease_duration
 
 
 class EngineVersion(Base):
@@ -123,13 +160,33 @@ class Model(Base):
         self.config = config
 
 
+# time of the last e-mail with the subject, shared by all server processes for MAX_EMAIL_FREQUENCY limit
 class Notification(Base):
     __tablename__ = 'notification'
     id = Column(Integer(), primary_key=True)
+    subject = Column(String(), nullable=True)
     last_notification = Column(DateTime(), nullable=False)
 
-    def __init__(self, last_notification):
+    __table_args__ = (
+        Index('ix_notification_subject', 'subject', unique=True),
+    )
+
+    def __init__(self, last_notification, subject=None):
         self.last_notification = last_notification
+        self.subject = subject
+
+
+# notification waiting for the next digest e-mail with its subject
+class QueuedNotification(Base):
+    __tablename__ = 'queued_notification'
+    id = Column(Integer(), primary_key=True)
+    subject = Column(String(), nullable=False, index=True)
+    body = Column(String(), nullable=False)
+    creation_timestamp = Column(DateTime(), nullable=False, default=datetime.datetime.now)
+
+    def __init__(self, subject, body):
+        self.subject = subject
+        self.body = body
 
 
 if __name__ == '__main__':
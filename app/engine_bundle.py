@@ -0,0 +1,60 @@
+import os
+import zipfile
+import tempfile
+from filelock import FileLock
+
+
+def get_engine_config_header(model_count):
+    if model_count == 2:
+        return ('[PAGE_PARSER]\n'
+                'RUN_LAYOUT_PARSER = yes\n'
+                'RUN_LINE_CROPPER = yes\n'
+                'RUN_OCR = yes\n'
+                'RUN_DECODER = no\n'
+                '\n\n')
+    elif model_count == 3:
+        return ('[PAGE_PARSER]\n'
+                'RUN_LAYOUT_PARSER = yes\n'
+                'RUN_LINE_CROPPER = yes\n'
+                'RUN_OCR = yes\n'
+                'RUN_DECODER = yes\n'
+                '\n\n')
+    raise ValueError(f'Engine has to have 2 or 3 models, it has {model_count}.')
+
+
+def get_engine_bundle_path(bundles_folder, engine_version_id):
+    return os.path.join(bundles_folder, '{}.zip'.format(engine_version_id))
+
+
+def build_engine_bundle(models, models_folder, bundles_folder, engine_version_id):
+    """
+    Builds zip archive with models and config of engine version unless it already exists. Bundle is never rebuilt,
+    changed models always get a new engine version.
+    @return: path to the bundle
+    """
+    bundle_path = get_engine_bundle_path(bundles_folder, engine_version_id)
+    if os.path.isfile(bundle_path):
+        return bundle_path
+
+    engine_config = get_engine_config_header(len(models))
+    with FileLock(bundle_path + '.lock'):
+        # other process could have built the bundle while waiting for the lock
+        if os.path.isfile(bundle_path):
+            return bundle_path
+
+        fd, tmp_path = tempfile.mkstemp(dir=bundles_folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zf:
+                    for model in models:
+                        for root, dirs, files in os.walk(os.path.join(models_folder, model.name)):
+                            for file in files:
+                                zf.write(os.path.join(root, file), os.path.join(model.name, file))
+                        engine_config += model.config + '\n\n'
+                    zf.writestr('config.ini', engine_config)
+            os.replace(tmp_path, bundle_path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    return bundle_path
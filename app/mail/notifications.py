@@ -0,0 +1,169 @@
+import datetime
+import threading
+import traceback
+
+import sqlalchemy
+from sqlalchemy import func
+
+from app.db.model import Notification, QueuedNotification
+from app.mail.mail import send_mail
+
+
+class NotificationQueue(object):
+    """
+    Sends notification e-mails from background thread, so slow mail server never blocks request handling.
+    Notifications are stored in the database and notifications with the same subject are coalesced into one digest,
+    which is sent at most once per MAX_EMAIL_FREQUENCY seconds by all server processes together. Queued notifications
+    survive restart of the server.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.config = None
+        self.session_factory = None
+        self.thread = None
+
+    def start(self, config, session_factory):
+        """
+        @param config: mapping with mail settings, app.config or Config
+        @param session_factory: factory of database sessions used by the queue
+        """
+        with self.condition:
+            self.config = {key: config[key] for key in ['EMAIL_NOTIFICATION_ADDRESSES', 'MAX_EMAIL_FREQUENCY',
+                                                        'MAX_NOTIFICATION_DIGEST_SIZE', 'NOTIFICATION_CHECK_INTERVAL',
+                                                        'MAIL_SERVER', 'MAIL_USERNAME', 'MAIL_PASSWORD']}
+            self.session_factory = session_factory
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def notify(self, subject, body):
+        """
+        Stores notification without waiting for mail server. Notifications are dropped when the queue was not
+        started or there are no recipients.
+        """
+        with self.condition:
+            if self.config is None or self.config['EMAIL_NOTIFICATION_ADDRESSES'] == []:
+                return
+
+        db_session = self.session_factory()
+        try:
+            db_session.add(QueuedNotification(subject, body))
+            db_session.commit()
+        except sqlalchemy.exc.SQLAlchemyError:
+            # notification is often about failing database, it must not break the request reporting it
+            db_session.rollback()
+            traceback.print_exc()
+            return
+        finally:
+            db_session.close()
+
+        with self.condition:
+            self.condition.notify()
+
+    def claim(self, db_session, subject, now):
+        """
+        Records sending of digest with subject unless some server process sent one in the last MAX_EMAIL_FREQUENCY
+        seconds. Has to be called at the beginning of transaction, which is rolled back if another process records the
+        first digest with the subject at the same time.
+        @return: True if the digest can be sent, otherwise time of the previous digest
+        """
+        frequency = datetime.timedelta(seconds=self.config['MAX_EMAIL_FREQUENCY'])
+        claimed = db_session.query(Notification).filter(Notification.subject == subject)\
+                                                .filter(Notification.last_notification <= now - frequency)\
+                                                .update({Notification.last_notification: now},
+                                                        synchronize_session=False)
+        if claimed:
+            return True
+
+        last_notification = db_session.query(Notification.last_notification)\
+                                      .filter(Notification.subject == subject)\
+                                      .scalar()
+        if last_notification is not None:
+            return last_notification
+
+        # first digest with the subject, unique subject lets only one of concurrent processes insert it
+        try:
+            db_session.add(Notification(now, subject))
+            db_session.flush()
+        except sqlalchemy.exc.IntegrityError:
+            db_session.rollback()
+            return now
+        return True
+
+    def next_digests(self):
+        """
+        Takes queued notifications of subjects whose digest can be sent without exceeding MAX_EMAIL_FREQUENCY.
+        @return: list of (subject, list of bodies, number of omitted notifications) and seconds until the next digest
+                 can be sent
+        """
+        digests = []
+        timeout = self.config['NOTIFICATION_CHECK_INTERVAL']
+        db_session = self.session_factory()
+        try:
+            subjects = [subject for subject, in db_session.query(QueuedNotification.subject).distinct().all()]
+            for subject in subjects:
+                now = datetime.datetime.now()
+                claimed = self.claim(db_session, subject, now)
+                if claimed is not True:
+                    db_session.commit()
+                    remaining = (claimed - now).total_seconds() + self.config['MAX_EMAIL_FREQUENCY']
+                    timeout = min(timeout, max(remaining, 0))
+                    continue
+
+                last_id, count = db_session.query(func.max(QueuedNotification.id), func.count(QueuedNotification.id))\
+                                           .filter(QueuedNotification.subject == subject)\
+                                           .one()
+                bodies = [body for body, in db_session.query(QueuedNotification.body)
+                                                      .filter(QueuedNotification.subject == subject)
+                                                      .filter(QueuedNotification.id <= last_id)
+                                                      .order_by(QueuedNotification.id)
+                                                      .limit(self.config['MAX_NOTIFICATION_DIGEST_SIZE'])
+                                                      .all()]
+                db_session.query(QueuedNotification).filter(QueuedNotification.subject == subject)\
+                                                    .filter(QueuedNotification.id <= last_id)\
+                                                    .delete(synchronize_session=False)
+                db_session.commit()
+                if bodies:
+                    digests.append((subject, bodies, count - len(bodies)))
+        except:
+            db_session.rollback()
+            raise
+        finally:
+            db_session.close()
+
+        return digests, timeout
+
+    def run(self):
+        while True:
+            try:
+                digests, timeout = self.next_digests()
+            except Exception:
+                traceback.print_exc()
+                digests, timeout = [], self.config['NOTIFICATION_CHECK_INTERVAL']
+
+            for subject, bodies, omitted in digests:
+                self.send(subject, bodies, omitted)
+
+            with self.condition:
+                self.condition.wait(timeout)
+
+    def send(self, subject, bodies, omitted):
+        body = "<br>".join(bodies)
+        if len(bodies) > 1 or omitted:
+            subject = f'{subject} ({len(bodies) + omitted} notifications)'
+        if omitted:
+            body += f'<br>{omitted} more notifications omitted.'
+
+        try:
+            send_mail(subject=subject,
+                      body=body,
+                      sender=('PERO OCR - API BOT', self.config['MAIL_USERNAME']),
+                      recipients=self.config['EMAIL_NOTIFICATION_ADDRESSES'],
+                      host=self.config['MAIL_SERVER'],
+                      password=self.config['MAIL_PASSWORD'])
+        except Exception:
+            traceback.print_exc()
+
+
+notification_queue = NotificationQueue()
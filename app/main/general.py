@@ -1,13 +1,18 @@
 import os
+import time
+import uuid
 import datetime
+import itertools
+import threading
 import sqlalchemy
-from sqlalchemy import func
+from sqlalchemy import func, case, bindparam
 from collections import defaultdict
 
 from app.db.model import Request, Engine, Page, PageState, ApiKey, EngineVersion, Model, EngineVersionModel, \
-                         PageState, Notification
+                         PageState, UNFINISHED_PAGE_STATES, PROCESSED_PAGE_STATES, FAILED_PAGE_STATES
 from flask_sqlalchemy_session import current_session as db_session
 from flask import current_app as app
+from app.waiting_pages import waiting_pages_notifier
 
 
 def request_exists(request_id):
@@ -22,44 +27,100 @@ def request_exists(request_id):
         return None
 
 
-def create_request(api_string, json_request):
+def create_request(api_key, json_request):
+    """
+    @param api_key: CachedApiKey of the request owner, requested priority is clamped to its max_priority
+    """
     engine_id = int(json_request["engine"])
     engine = db_session.query(Engine).filter(Engine.id == engine_id).first()
-    api_key = db_session.query(ApiKey).filter(ApiKey.api_string == api_string).first()
     if engine is not None:
+        images = json_request["images"]
         request = Request(engine.id, api_key.id)
+        request.page_count = len(images)
+        max_priority = min(api_key.max_priority, app.config['MAX_REQUEST_PRIORITY'])
+        request.priority = max(0, min(int(json_request.get("priority", 0)), max_priority))
         db_session.add(request)
+        db_session.flush()
+        timestamp = datetime.datetime.utcnow()
+
+        # pages are inserted by executemany in batches, without creating ORM object for each of them
+        image_items = iter(images.items())
+        while True:
+            batch = list(itertools.islice(image_items, app.config['PAGE_INSERT_BATCH_SIZE']))
+            if not batch:
+                break
+            db_session.execute(Page.__table__.insert(), [
+                {'id': uuid.uuid4(),
+                 'name': image_name,
+                 'url': image_url,
+                 'state': PageState.CREATED if image_url is None else PageState.WAITING,
+                 'waiting_timestamp': None if image_url is None else timestamp,
+                 'request_id': request.id} for image_name, image_url in batch])
         db_session.commit()
-        for image_name in json_request["images"]:
-            if json_request["images"][image_name] is None:
-                page = Page(image_name, None, PageState.CREATED, request.id)
-            else:
-                page = Page(image_name, json_request["images"][image_name], PageState.WAITING, request.id)
-            db_session.add(page)
-        db_session.commit()
+        waiting_pages_notifier.notify()
         return request, engine_id
     return None, engine_id
 
 
-def get_document_status(request_id):
-    all = db_session.query(Page).filter(Page.request_id == request_id).count()
-    not_processed = db_session.query(Page).filter(Page.request_id == request_id).filter(Page.state.in_([PageState.CREATED, PageState.WAITING, PageState.PROCESSING])).count()
-    status = (all - not_processed) / all
-
-    quality = db_session.query(func.avg(Page.score)).filter(Page.request_id == request_id).filter(Page.state == PageState.PROCESSED).first()[0]
+def get_request_summary(request):
+    """
+    @return: summary of request computed from its page counters
+    """
+    if request.page_count > 0:
+        status = request.finished_page_count / request.page_count
+    else:
+        status = 1.0
 
-    return status, quality
+    if request.processed_page_count > 0:
+        quality = request.score_sum / request.processed_page_count
+    else:
+        quality = None
+
+    return {'page_count': request.page_count,
+            'finished_page_count': request.finished_page_count,
+            'processed_page_count': request.processed_page_count,
+            'failed_page_count': request.failed_page_count,
+            'status': status,
+            'quality': quality}
+
+
+def update_request_counters(request_id, timestamp, finished=0, processed=0, failed=0, score=0):
+    """
+    Adds to page counters of request in the database, so concurrent updates are not lost, and sets finish timestamp
+    when all pages of request are finished. Has to be committed together with the page state change.
+    """
+    db_session.query(Request).filter(Request.id == request_id).update({
+        Request.finished_page_count: Request.finished_page_count + finished,
+        Request.processed_page_count: Request.processed_page_count + processed,
+        Request.failed_page_count: Request.failed_page_count + failed,
+        Request.score_sum: Request.score_sum + score,
+        Request.modification_timestamp: timestamp,
+        Request.finish_timestamp: case([(Request.finished_page_count + finished >= Request.page_count, timestamp)],
+                                       else_=Request.finish_timestamp)},
+        synchronize_session=False)
+
+
+def update_request_counters_by_page(request_id, old_state, new_state, old_score, new_score, timestamp):
+    score = 0
+    if old_state in PROCESSED_PAGE_STATES and old_score is not None:
+        score -= old_score
+    if new_state in PROCESSED_PAGE_STATES and new_score is not None:
+        score += new_score
+
+    update_request_counters(request_id, timestamp,
+                            finished=(old_state in UNFINISHED_PAGE_STATES) - (new_state in UNFINISHED_PAGE_STATES),
+                            processed=(new_state in PROCESSED_PAGE_STATES) - (old_state in PROCESSED_PAGE_STATES),
+                            failed=(new_state in FAILED_PAGE_STATES) - (old_state in FAILED_PAGE_STATES),
+                            score=score)
 
 
 def cancel_request_by_id(request_id):
-    waiting_pages = db_session.query(Page).filter(Page.request_id == request_id) \
-                                          .filter(Page.state.in_([PageState.CREATED, PageState.WAITING, PageState.PROCESSING]))\
-                                          .all()
-
     timestamp = datetime.datetime.utcnow()
-    for page in waiting_pages:
-        page.state = PageState.CANCELED
-        page.finish_timestamp = timestamp
+    canceled = db_session.query(Page).filter(Page.request_id == request_id) \
+                                     .filter(Page.state.in_(UNFINISHED_PAGE_STATES))\
+                                     .update({Page.state: PageState.CANCELED, Page.finish_timestamp: timestamp},
+                                             synchronize_session=False)
+    update_request_counters(request_id, timestamp, finished=canceled)
     db_session.commit()
 
 
@@ -80,32 +141,277 @@ def get_page_by_id(page_id):
 
 
 def check_save_path(request_id):
-    if not os.path.isdir(os.path.join(app.config['PROCESSED_REQUESTS_FOLDER'], str(request_id))):
-        os.mkdir(os.path.join(app.config['PROCESSED_REQUESTS_FOLDER'], str(request_id)))
+    os.makedirs(os.path.join(app.config['PROCESSED_REQUESTS_FOLDER'], str(request_id)), exist_ok=True)
+
 
+def get_page_by_preferred_engine(engine_id, wait=0, loaded_engine_ids=()):
+    pages, engine_id = wait_for_pages_by_preferred_engine(engine_id, 1, wait, loaded_engine_ids)
+    if pages:
+        return pages[0], engine_id
+    return None, engine_id
 
-def get_page_by_preferred_engine(engine_id):
-    page = db_session.query(Page).join(Request).join(ApiKey).filter(Page.state == PageState.WAITING)\
-                                                            .filter(Request.engine_id == engine_id)\
-                                                            .filter(ApiKey.suspension == False).first()
-    if not page:
-        page = db_session.query(Page).join(Request).join(ApiKey).filter(ApiKey.suspension == False)\
-                                                  .filter(Page.state == PageState.WAITING).first()
 
-        if page:
-            engine_id = db_session.query(Request.engine_id).filter(Request.id == page.request_id).first()[0]
+def wait_for_pages_by_preferred_engine(engine_id, count, wait, loaded_engine_ids=()):
+    """
+    Leases pages like get_pages_by_preferred_engine, when there are none, waits up to wait seconds for new ones.
+    """
+    deadline = time.time() + wait
+    while True:
+        generation = waiting_pages_notifier.generation
+        pages, leased_engine_id = get_pages_by_preferred_engine(engine_id, count, loaded_engine_ids)
+        remaining = deadline - time.time()
+        if pages or remaining <= 0:
+            return pages, leased_engine_id
+        # ends transaction of the empty lease, so the waiting client does not hold pooled database connection
+        db_session.rollback()
+        waiting_pages_notifier.wait(generation, min(remaining, app.config['PROCESSING_REQUEST_RECHECK_INTERVAL']))
+
+
+def get_pages_by_preferred_engine(engine_id, count, loaded_engine_ids=()):
+    chosen_engine_id = choose_engine(engine_id, loaded_engine_ids)
+    if chosen_engine_id is None:
+        return [], engine_id
+
+    pages = lease_pages(chosen_engine_id, count)
+    if not pages:
+        # statistics promised pages which are gone, next attempt has to see the current state
+        invalidate_dispatch_statistics()
+    return pages, chosen_engine_id
+
+
+dispatch_statistics_cache = dict()
+dispatch_statistics_lock = threading.Lock()
+
+
+def get_dispatch_statistics():
+    """
+    Returns page counts used for dispatching pages to processing clients. Snapshot is shared by dispatch requests of
+    the server process for DISPATCH_STATISTICS_CACHE_TIME seconds or until new pages are WAITING, pages leased in the
+    meantime are subtracted from it by lease_pages.
+    @return: copy of dictionaries {(engine_id, api_key_id, priority): (WAITING page count, time since which the
+             oldest page waits)} for not suspended API keys and {(engine_id, api_key_id): PROCESSING page count}
+    """
+    generation = waiting_pages_notifier.generation
+    with dispatch_statistics_lock:
+        cached = dispatch_statistics_cache.get('snapshot')
+        if cached is not None and cached[1] == generation \
+                and time.time() - cached[0] < app.config['DISPATCH_STATISTICS_CACHE_TIME']:
+            return dict(cached[2]), dict(cached[3])
+
+    # pages which became WAITING before waiting_timestamp was introduced wait since creation of their request
+    waiting_pages = db_session.query(Request.engine_id, Request.api_key_id, Request.priority, func.count(Page.id),
+                                     func.min(func.coalesce(Page.waiting_timestamp, Request.creation_timestamp)))\
+                              .select_from(Page).join(Request).join(ApiKey)\
+                              .filter(Page.state == PageState.WAITING)\
+                              .filter(ApiKey.suspension == False)\
+                              .group_by(Request.engine_id, Request.api_key_id, Request.priority)\
+                              .all()
+    processing_pages = db_session.query(Request.engine_id, Request.api_key_id, func.count(Page.id))\
+                                 .select_from(Page).join(Request)\
+                                 .filter(Page.state == PageState.PROCESSING)\
+                                 .group_by(Request.engine_id, Request.api_key_id)\
+                                 .all()
+    waiting_pages = {(engine_id, api_key_id, priority): (page_count, timestamp)
+                     for engine_id, api_key_id, priority, page_count, timestamp in waiting_pages}
+    processing_pages = {(engine_id, api_key_id): page_count for engine_id, api_key_id, page_count in processing_pages}
+
+    with dispatch_statistics_lock:
+        dispatch_statistics_cache['snapshot'] = (time.time(), generation, waiting_pages, processing_pages)
+    return dict(waiting_pages), dict(processing_pages)
+
+
+def update_dispatch_statistics(engine_id, leased_pages):
+    """
+    Moves pages leased by this server process from WAITING to PROCESSING in cached snapshot, so fair share of
+    following leases does not see stale counts.
+    @param leased_pages: dictionary {(api_key_id, priority): number of leased pages}
+    """
+    with dispatch_statistics_lock:
+        cached = dispatch_statistics_cache.get('snapshot')
+        if cached is None:
+            return
+        _, _, waiting_pages, processing_pages = cached
+        for (api_key_id, priority), page_count in leased_pages.items():
+            key = (engine_id, api_key_id, priority)
+            if key in waiting_pages:
+                waiting_count, timestamp = waiting_pages[key]
+                waiting_pages[key] = (max(waiting_count - page_count, 0), timestamp)
+            processing_pages[(engine_id, api_key_id)] = processing_pages.get((engine_id, api_key_id), 0) + page_count
+
+
+def invalidate_dispatch_statistics():
+    with dispatch_statistics_lock:
+        dispatch_statistics_cache.pop('snapshot', None)
+
+
+def choose_engine(preferred_engine_id, loaded_engine_ids=()):
+    """
+    Chooses engine of pages for processing client. Client keeps its preferred engine or other engines it has loaded
+    while they have waiting pages. It is moved to another engine only when the engine has at least
+    ENGINE_SWITCH_MIN_BACKLOG_PER_PAGE waiting pages per its page in processing (plus one), or when nobody processes
+    the engine and its pages wait longer than ENGINE_SWITCH_MAX_WAIT seconds. Pages do not know which client leased
+    them, so the backlog is measured per leased page, not per client.
+    @return: engine ID or None if client should not get any page
+    """
+    waiting, processing = get_dispatch_statistics()
+    waiting_pages = dict()
+    waiting_since = dict()
+    for (engine_id, _, _), (page_count, timestamp) in waiting.items():
+        if page_count > 0:
+            waiting_pages[engine_id] = waiting_pages.get(engine_id, 0) + page_count
+            waiting_since[engine_id] = min(timestamp, waiting_since.get(engine_id, timestamp))
+
+    if preferred_engine_id in waiting_pages:
+        return preferred_engine_id
+    loaded_engine_ids = [engine_id for engine_id in loaded_engine_ids if engine_id in waiting_pages]
+    if loaded_engine_ids:
+        return max(loaded_engine_ids, key=lambda engine_id: waiting_pages[engine_id])
+
+    processing_pages = defaultdict(int)
+    for (engine_id, _), page_count in processing.items():
+        processing_pages[engine_id] += page_count
+    max_wait_timestamp = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['ENGINE_SWITCH_MAX_WAIT'])
+    best_engine_id = None
+    best_backlog = 0
+    for engine_id, count in waiting_pages.items():
+        processing = processing_pages[engine_id]
+        backlog = count / (processing + 1)
+        starving = processing == 0 and waiting_since[engine_id] < max_wait_timestamp
+        if (backlog >= app.config['ENGINE_SWITCH_MIN_BACKLOG_PER_PAGE'] or starving) and backlog > best_backlog:
+            best_engine_id = engine_id
+            best_backlog = backlog
+
+    return best_engine_id
+
+
+def lease_pages(engine_id, count):
+    """
+    Atomically switches up to count WAITING pages of engine to PROCESSING. Pages are shared among API keys by
+    get_fair_share, pages of each API key are leased from its oldest requests first.
+    @return: list of rows with id and url of leased pages.
+    """
+    timestamp = datetime.datetime.now()
+    pages = []
+    leased_pages = dict()
+    for (api_key_id, priority), page_count in get_fair_share(engine_id, count).items():
+        candidates = get_lease_candidates(engine_id, api_key_id, priority, page_count)
+        claimed = claim_pages(candidates, timestamp)
+        leased_pages[(api_key_id, priority)] = len(claimed)
+        pages += claimed
+    db_session.commit()
+    update_dispatch_statistics(engine_id, leased_pages)
+
+    return pages
 
-    if page:
-        page.state = PageState.PROCESSING
-        page.processing_timestamp = datetime.datetime.now()
-        db_session.commit()
 
-    return page, engine_id
+def get_lease_candidates(engine_id, api_key_id, priority, count):
+    """
+    @return: query of IDs of up to count WAITING pages of API key and priority, oldest requests first and pages of
+             request by name
+    """
+    return db_session.query(Page.id).join(Request)\
+                     .filter(Page.state == PageState.WAITING)\
+                     .filter(Request.engine_id == engine_id)\
+                     .filter(Request.api_key_id == api_key_id)\
+                     .filter(Request.priority == priority)\
+                     .order_by(Request.creation_timestamp, Page.request_id, Page.name)\
+                     .limit(count)
+
+
+def get_fair_share(engine_id, count):
+    """
+    Splits count pages among API keys with waiting pages of engine. Only requests with the highest priority are
+    served, each page is given to the API key with the fewest pages in processing, so a large request of one API key
+    does not starve requests of other API keys.
+    @return: dictionary {(api_key_id, priority): page_count}
+    """
+    waiting, processing = get_dispatch_statistics()
+    waiting_pages = [(api_key_id, priority, page_count)
+                     for (waiting_engine_id, api_key_id, priority), (page_count, _) in waiting.items()
+                     if waiting_engine_id == engine_id and page_count > 0]
+    if not waiting_pages:
+        return dict()
+
+    max_priority = max(priority for _, priority, _ in waiting_pages)
+    waiting_pages = {api_key_id: page_count for api_key_id, priority, page_count in waiting_pages
+                     if priority == max_priority}
+    processing_pages = defaultdict(int)
+    for (_, api_key_id), page_count in processing.items():
+        if api_key_id in waiting_pages:
+            processing_pages[api_key_id] += page_count
+
+    share = dict()
+    for _ in range(count):
+        api_key_ids = [api_key_id for api_key_id in waiting_pages if waiting_pages[api_key_id] > 0]
+        if not api_key_ids:
+            break
+        api_key_id = min(api_key_ids, key=lambda api_key_id: processing_pages[api_key_id])
+        waiting_pages[api_key_id] -= 1
+        processing_pages[api_key_id] += 1
+        share[(api_key_id, max_priority)] = share.get((api_key_id, max_priority), 0) + 1
+
+    return share
+
+
+def claim_pages(candidates, timestamp):
+    """
+    Atomically switches WAITING pages selected by candidates query to PROCESSING. Has to be committed.
+    @return: list of rows with id and url of claimed pages.
+    """
+    if db_session.bind.dialect.name == 'postgresql':
+        # Single UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING statement, concurrent
+        # clients skip rows locked by each other instead of leasing the same page twice.
+        page_table = Page.__table__
+        candidates = candidates.with_for_update(of=page_table, skip_locked=True)
+        pages = db_session.execute(page_table.update()
+                                             .where(page_table.c.id.in_(candidates.statement))
+                                             .values(state=PageState.PROCESSING, processing_timestamp=timestamp)
+                                             .returning(page_table.c.id, page_table.c.url)).fetchall()
+    else:
+        # SQLite has a single writer, page is leased only if it is still WAITING when the update is executed.
+        page_ids = []
+        for page_id, in candidates.all():
+            updated = db_session.query(Page).filter(Page.id == page_id)\
+                                            .filter(Page.state == PageState.WAITING)\
+                                            .update({Page.state: PageState.PROCESSING,
+                                                     Page.processing_timestamp: timestamp},
+                                                    synchronize_session=False)
+            if updated:
+                page_ids.append(page_id)
+
+        pages = []
+        if page_ids:
+            pages = db_session.query(Page.id, Page.url).filter(Page.id.in_(page_ids)).all()
+
+    return pages
+
+
+def get_lease_duration(engine_id):
+    """
+    @return: seconds for which page of engine stays leased to processing client without renewal
+    """
+    lease_duration = db_session.query(Engine.lease_duration).filter(Engine.id == engine_id).scalar()
+    if lease_duration is None:
+        return app.config['PAGE_LEASE_DURATION']
+    return lease_duration
+
+
+def renew_page_leases(page_ids):
+    """
+    Extends leases of pages which are still in processing by a single UPDATE, processing timestamp is the time of
+    last renewal.
+    @return: number of renewed leases
+    """
+    renewed = db_session.query(Page).filter(Page.id.in_(page_ids))\
+                                    .filter(Page.state == PageState.PROCESSING)\
+                                    .update({Page.processing_timestamp: datetime.datetime.now()},
+                                            synchronize_session=False)
+    db_session.commit()
+    return renewed
 
 
-def request_belongs_to_api_key(api_key, request_id):
-    api_key = db_session.query(ApiKey).filter(ApiKey.api_string == api_key).first()
-    request = db_session.query(Request).filter(Request.api_key_id == api_key.id).filter(Request.id == request_id).first()
+def request_belongs_to_api_key(api_key_id, request_id):
+    request = db_session.query(Request).filter(Request.api_key_id == api_key_id).filter(Request.id == request_id).first()
     return request
 
 
@@ -126,27 +432,60 @@ def get_engine_by_page_id(page_id):
     return engine
 
 
-def get_page_statistics(history_hours=24):
+page_statistics_cache = dict()
+page_statistics_lock = threading.Lock()
+
+
+def get_page_statistics(history_hours=None):
+    """
+    Returns page statistics, snapshot computed by other request is reused for PAGE_STATISTICS_CACHE_TIME seconds.
+    """
+    if history_hours is None:
+        history_hours = app.config['PAGE_STATISTICS_HISTORY_HOURS']
+
+    with page_statistics_lock:
+        cached = page_statistics_cache.get(history_hours)
+    if cached is not None and time.time() - cached[0] < app.config['PAGE_STATISTICS_CACHE_TIME']:
+        return cached[1]
+
+    statistics = compute_page_statistics(history_hours)
+    with page_statistics_lock:
+        page_statistics_cache[history_hours] = (time.time(), statistics)
+
+    return statistics
+
+
+def compute_page_statistics(history_hours):
     from_datetime = datetime.datetime.utcnow() - datetime.timedelta(hours=history_hours)
-    finished_pages = db_session.query(Page).filter(Page.finish_timestamp > from_datetime).all()
-    unfinished_pages = db_session.query(Page).filter(Page.finish_timestamp == None).all()
     state_stats = {state.name: 0 for state in PageState if state != PageState.CREATED}
-    engine_stats = {engine.id: 0 for engine in db_session.query(Engine).all()}
-    request_to_engine = {request.id: request.engine_id for request in db_session.query(Request).all()}
-
-    for page_db in finished_pages:
-        state_stats[page_db.state.name] += 1
-    for page_db in unfinished_pages:
-        if page_db.state == PageState.WAITING or page_db.state == PageState.PROCESSING:
-            state_stats[page_db.state.name] += 1
-        engine_stats[request_to_engine[page_db.request_id]] += 1
+    engine_stats = {engine_id: 0 for engine_id, in db_session.query(Engine.id).all()}
+
+    finished_pages = db_session.query(Page.state, func.count(Page.id))\
+                               .filter(Page.finish_timestamp > from_datetime)\
+                               .group_by(Page.state)\
+                               .all()
+    unfinished_pages = db_session.query(Request.engine_id, Page.state, func.count(Page.id))\
+                                 .select_from(Page)\
+                                 .join(Request)\
+                                 .filter(Page.finish_timestamp == None)\
+                                 .group_by(Request.engine_id, Page.state)\
+                                 .all()
+
+    for state, count in finished_pages:
+        if state.name in state_stats:
+            state_stats[state.name] += count
+    for engine_id, state, count in unfinished_pages:
+        if state == PageState.WAITING or state == PageState.PROCESSING:
+            state_stats[state.name] += count
+        engine_stats[engine_id] += count
 
     return state_stats, engine_stats
 
 
 def change_page_to_processed(page_id, score, engine_version):
-    page = db_session.query(Page).filter(Page.id == page_id).first()
-    request = db_session.query(Request).filter(Request.id == page.request_id).first()
+    page = db_session.query(Page).filter(Page.id == page_id).with_for_update().first()
+    old_state = page.state
+    old_score = page.score
 
     page.score = score
     page.state = PageState.PROCESSED
@@ -154,16 +493,13 @@ def change_page_to_processed(page_id, score, engine_version):
 
     timestamp = datetime.datetime.utcnow()
     page.finish_timestamp = timestamp
-    request.modification_timestamp = timestamp
+    update_request_counters_by_page(page.request_id, old_state, page.state, old_score, page.score, timestamp)
     db_session.commit()
-    if is_request_processed(request.id):
-        request.finish_timestamp = timestamp
-        db_session.commit()
 
 
 def change_page_to_failed(page_id, fail_type, traceback, engine_version):
-    page = db_session.query(Page).filter(Page.id == page_id).first()
-    request = db_session.query(Request).filter(Request.id == page.request_id).first()
+    page = db_session.query(Page).filter(Page.id == page_id).with_for_update().first()
+    old_state = page.state
 
     if fail_type == 'NOT_FOUND':
         page.state = PageState.NOT_FOUND
@@ -176,19 +512,8 @@ def change_page_to_failed(page_id, fail_type, traceback, engine_version):
 
     timestamp = datetime.datetime.utcnow()
     page.finish_timestamp = timestamp
-    request.modification_timestamp = timestamp
+    update_request_counters_by_page(page.request_id, old_state, page.state, page.score, page.score, timestamp)
     db_session.commit()
-    if is_request_processed(request.id):
-        request.finish_timestamp = timestamp
-        db_session.commit()
-
-
-def is_request_processed(request_id):
-    status, _ = get_document_status(request_id)
-    if status == 1.0:
-        return True
-    else:
-        return False
 
 
 def get_page_and_page_state(request_id, name):
@@ -206,8 +531,13 @@ def get_engine(engine_id):
     return engine
 
 
-def get_latest_models(engine_id):
+def get_latest_engine_version(engine_id):
     engine_version = db_session.query(EngineVersion).filter(EngineVersion.engine_id == engine_id).order_by(EngineVersion.id.desc()).first()
+    return engine_version
+
+
+def get_latest_models(engine_id):
+    engine_version = get_latest_engine_version(engine_id)
     models = db_session.query(Model)\
                        .outerjoin(EngineVersionModel)\
                        .filter(EngineVersionModel.engine_version_id == engine_version.id)\
@@ -220,11 +550,52 @@ def get_document_pages(request_id):
     return pages
 
 
+def get_processed_pages(request_id, since=None):
+    query = db_session.query(Page.id, Page.name).filter(Page.request_id == request_id)\
+                                               .filter(Page.state == PageState.PROCESSED)
+    if since is not None:
+        query = query.filter(Page.finish_timestamp > since)
+    pages = query.order_by(Page.name).all()
+    return pages
+
+
 def change_page_path(request_id, page_name, new_url):
     page = db_session.query(Page).filter(Page.request_id == request_id).filter(Page.name == page_name).first()
     page.url = new_url
     page.state = PageState.WAITING
+    page.waiting_timestamp = datetime.datetime.utcnow()
+    db_session.commit()
+    waiting_pages_notifier.notify()
+
+
+def get_created_page_names(request_id):
+    """
+    @return: set of names of request pages waiting for image upload
+    """
+    pages = db_session.query(Page.name).filter(Page.request_id == request_id)\
+                                       .filter(Page.state == PageState.CREATED)\
+                                       .all()
+    return {name for name, in pages}
+
+
+def change_page_paths(request_id, page_urls):
+    """
+    Sets urls of uploaded images and switches pages from CREATED to WAITING by one executemany UPDATE.
+    @param page_urls: dictionary {page_name: url}
+    """
+    if not page_urls:
+        return
+    page_table = Page.__table__
+    db_session.execute(page_table.update()
+                                 .where(page_table.c.request_id == bindparam('b_request_id'))
+                                 .where(page_table.c.name == bindparam('b_name'))
+                                 .where(page_table.c.state == PageState.CREATED)
+                                 .values(url=bindparam('b_url'), state=PageState.WAITING,
+                                         waiting_timestamp=datetime.datetime.utcnow()),
+                       [{'b_request_id': request_id, 'b_name': page_name, 'b_url': url}
+                        for page_name, url in page_urls.items()])
     db_session.commit()
+    waiting_pages_notifier.notify()
 
 
 def get_request_by_page(page):
@@ -237,12 +608,23 @@ def get_api_key_by_id(api_id):
     return request
 
 
-def get_notification():
-    notification = db_session.query(Notification).first()
-    return notification.last_notification
-
-
-def set_notification():
-    notification = db_session.query(Notification).first()
-    notification.last_notification = datetime.datetime.now()
-    db_session.commit()
+def get_engine_queue_metrics():
+    """
+    @return: dictionary {engine_id: (waiting page count, processing page count, age of the oldest lease in seconds)}
+    """
+    now = datetime.datetime.now()
+    queues = defaultdict(lambda: [0, 0, 0.0])
+    rows = db_session.query(Request.engine_id, Page.state, func.count(Page.id), func.min(Page.processing_timestamp))\
+                     .select_from(Page).join(Request)\
+                     .filter(Page.state.in_([PageState.WAITING, PageState.PROCESSING]))\
+                     .group_by(Request.engine_id, Page.state)\
+                     .all()
+    for engine_id, state, page_count, oldest_lease in rows:
+        if state == PageState.WAITING:
+            queues[engine_id][0] = page_count
+        else:
+            queues[engine_id][1] = page_count
+            if oldest_lease is not None:
+                queues[engine_id][2] = (now - oldest_lease).total_seconds()
+
+    return {engine_id: tuple(queue) for engine_id, queue in queues.items()}
@@ -0,0 +1,123 @@
+import os
+import time
+import tarfile
+import zipfile
+import tempfile
+
+from flask import current_app as app
+
+
+# file name suffix and download extension of each result format
+RESULT_FORMATS = {'alto': ('_alto.xml', 'xml'),
+                  'page': ('_page.xml', 'xml'),
+                  'txt': ('.txt', 'txt')}
+ARCHIVE_FORMATS = {'zip': 'application/zip',
+                   'tar': 'application/x-tar'}
+CHUNK_SIZE = 64 * 1024
+
+
+def get_request_results_path(request_id):
+    return os.path.join(app.config['PROCESSED_REQUESTS_FOLDER'], str(request_id))
+
+
+def get_page_result_path(request_id, page_id, format):
+    return os.path.join(get_request_results_path(request_id), str(page_id) + RESULT_FORMATS[format][0])
+
+
+def save_page_result(request_id, page_id, format, data):
+    """
+    Writes result file of page. File is written under temporary name and renamed, so concurrent uploads of the
+    same page never leave a partially written file.
+    """
+    path = get_page_result_path(request_id, page_id, format)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def open_page_result(request_id, page_id, page_name, format):
+    """
+    Opens result file of page. Results uploaded before per-page storage are read from request zip archive.
+    @return: binary file object and its size, None if result does not exist
+    """
+    path = get_page_result_path(request_id, page_id, format)
+    if os.path.isfile(path):
+        return open(path, 'rb'), os.path.getsize(path)
+
+    archive_path = os.path.join(get_request_results_path(request_id), str(request_id) + '.zip')
+    if os.path.isfile(archive_path):
+        with zipfile.ZipFile(archive_path, 'r') as archive:
+            try:
+                info = archive.getinfo(page_name + RESULT_FORMATS[format][0])
+            except KeyError:
+                return None
+            # opened member keeps archive file open after the archive is closed
+            return archive.open(info), info.file_size
+
+    return None
+
+
+class StreamWriter(object):
+    """
+    Write-only file object collecting data written by zipfile or tarfile, so they can be sent as response chunks.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_request_results(request_id, pages, formats, archive_format):
+    """
+    Generates zip or tar archive with results of pages piece by piece without keeping it in memory.
+    @param pages: list of (page_id, page_name) tuples
+    """
+    stream = StreamWriter()
+    if archive_format == 'tar':
+        archive = tarfile.open(fileobj=stream, mode='w|')
+    else:
+        archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+
+    for page_id, page_name in pages:
+        for format in formats:
+            result = open_page_result(request_id, page_id, page_name, format)
+            if result is None:
+                continue
+
+            file, size = result
+            name = page_name + RESULT_FORMATS[format][0]
+            with file:
+                if archive_format == 'tar':
+                    info = tarfile.TarInfo(name)
+                    info.size = size
+                    info.mtime = time.time()
+                    archive.addfile(info, file)
+                else:
+                    with archive.open(name, 'w') as member:
+                        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                            member.write(chunk)
+                            data = stream.pop()
+                            if data:
+                                yield data
+            data = stream.pop()
+            if data:
+                yield data
+
+    archive.close()
+    yield stream.pop()
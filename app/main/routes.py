@@ -1,12 +1,15 @@
 import os
 import os.path
-import zipfile
+import zlib
+import lzma
+import time
 import datetime
+import tarfile
+import zipfile
 import traceback
-from io import BytesIO
+import sqlalchemy
 from urllib.parse import urlparse
-from filelock import FileLock, Timeout
-from flask import redirect, request, jsonify, send_file, abort
+from flask import redirect, request, jsonify, send_file, abort, g, Response, stream_with_context
 from pathlib import Path
 from app.main import bp
 from app.db.api_key import require_user_api_key, require_super_user_api_key
@@ -15,18 +18,28 @@ from flask import current_app as app
 from flask import render_template
 from app.main.general import create_request, request_exists, cancel_request_by_id, \
                              get_engine_dict, get_page_by_id, check_save_path, get_page_by_preferred_engine, \
+                             wait_for_pages_by_preferred_engine, \
                              request_belongs_to_api_key, get_engine_version, get_engine_by_page_id, \
                              change_page_to_processed, get_page_and_page_state, get_engine, get_latest_models, \
                              get_document_pages, change_page_to_failed, get_page_statistics, change_page_path, \
-                             get_request_by_page, get_notification, set_notification, get_api_key_by_id
-from app.mail.mail import send_mail
+                             get_request_by_page, get_api_key_by_id, \
+                             get_processed_pages, get_request_summary, get_latest_engine_version, \
+                             get_lease_duration, renew_page_leases, get_engine_queue_metrics, \
+                             get_created_page_names, change_page_paths
+from app.engine_bundle import build_engine_bundle, get_engine_bundle_path
+from app.main.results import RESULT_FORMATS, ARCHIVE_FORMATS, save_page_result, open_page_result, \
+                             stream_request_results
+from app.main.uploads import UploadOffsetMismatch, ArchiveTooLarge, start_image_upload, append_image_chunk, \
+                             finish_image_upload, extract_image_archive
+from app.mail.notifications import notification_queue
+from app import metrics
 
 
 @bp.route('/')
 @bp.route('/index')
 def index():
     state_stats, _ = get_page_statistics()
-    return render_template('index.html', data=state_stats)
+    return render_template('index.html', data=state_stats, history_hours=app.config['PAGE_STATISTICS_HISTORY_HOURS'])
 
 
 @bp.route('/docs')
@@ -37,9 +50,13 @@ def documentation():
 @bp.route('/post_processing_request', methods=['POST'])
 @require_user_api_key
 def post_processing_request():
-    api_string = request.headers.get('api-key')
+    if request.content_length is not None and request.content_length > app.config['MAX_PROCESSING_REQUEST_SIZE']:
+        return jsonify({
+            'status': 'failure',
+            'message': f'Request is too large. Maximal request size is {app.config["MAX_PROCESSING_REQUEST_SIZE"]} bytes.'}), 413
+
     try:
-        db_request, engine_id = create_request(api_string, request.json)
+        db_request, engine_id = create_request(g.api_key, request.json)
     except:
         exception = traceback.format_exc()
         return jsonify({
@@ -66,7 +83,7 @@ def upload_image(request_id, page_name):
         return jsonify({
             'status': 'failure',
             'message': f'Request {request_id} does not exist.'}), 404
-    if not request_belongs_to_api_key(request.headers.get('api-key'), request_id):
+    if not request_belongs_to_api_key(g.api_key.id, request_id):
         return jsonify({
             'status': 'failure',
             'message': f'Request {request_id} does not belong to API key {api_string}.'}), 401
@@ -102,24 +119,202 @@ def upload_image(request_id, page_name):
             'message': f'{extension} is not supported format. Supported formats are {allowed_extesions}.'}), 422
 
 
+@bp.route('/upload_images/<string:request_id>', methods=['POST'])
+@require_user_api_key
+def upload_images(request_id):
+    api_string = request.headers.get('api-key')
+    if not request_exists(request_id):
+        return jsonify({
+            'status': 'failure',
+            'message': f'Request {request_id} does not exist.'}), 404
+    if not request_belongs_to_api_key(g.api_key.id, request_id):
+        return jsonify({
+            'status': 'failure',
+            'message': f'Request {request_id} does not belong to API key {api_string}.'}), 401
+
+    archive_format = request.args.get('archive', default='tar')
+    if archive_format not in ARCHIVE_FORMATS:
+        return jsonify({
+            'status': 'failure',
+            'message': 'Bad archive format. Supported formats are zip, tar.'}), 400
+    if request.content_length is not None and request.content_length > app.config['MAX_IMAGE_ARCHIVE_SIZE']:
+        return jsonify({
+            'status': 'failure',
+            'message': f'Archive is too large. Maximal archive size is {app.config["MAX_IMAGE_ARCHIVE_SIZE"]} bytes.'}), 413
+
+    extracted = dict()
+    skipped = []
+    error = None
+    error_code = 400
+    try:
+        for member_name, page_name, extension in extract_image_archive(request_id, request.stream, archive_format,
+                                                                       get_created_page_names(request_id)):
+            if page_name is None:
+                skipped.append(member_name)
+            else:
+                extracted[page_name] = extension
+    except ArchiveTooLarge as e:
+        error = f'Archive is too large. Maximal archive size is {e.max_size} bytes.'
+        error_code = 413
+    except (tarfile.TarError, zipfile.BadZipFile, EOFError, zlib.error, lzma.LZMAError, OSError):
+        # corrupted bz2 stream is reported as OSError
+        error = f'Request does not contain valid {archive_format} archive.'
+
+    # images extracted before a broken part of archive are kept, so only the rest has to be uploaded again
+    o = urlparse(request.base_url)
+    change_page_paths(request_id, {page_name: f'{o.scheme}://{o.netloc}{app.config["APPLICATION_ROOT"]}'
+                                              f'/download_image/{request_id}/{page_name}.{extension}'
+                                   for page_name, extension in extracted.items()})
+
+    if error is not None:
+        return jsonify({
+            'status': 'failure',
+            'message': error,
+            'uploaded_page_count': len(extracted)}), error_code
+    return jsonify({
+        'status': 'success',
+        'uploaded_page_count': len(extracted),
+        'skipped_files': skipped}), 200
+
+
+def check_chunked_image_upload(request_id, file_name):
+    """
+    Checks that image of page can be uploaded by chunked upload. File name is page name with image extension.
+    @return: page name, extension and error response, which is None when upload is allowed
+    """
+    page_name, _, extension = file_name.rpartition('.')
+    extension = extension.lower()
+    api_string = request.headers.get('api-key')
+    if not request_exists(request_id):
+        return page_name, extension, (jsonify({
+            'status': 'failure',
+            'message': f'Request {request_id} does not exist.'}), 404)
+    if not request_belongs_to_api_key(g.api_key.id, request_id):
+        return page_name, extension, (jsonify({
+            'status': 'failure',
+            'message': f'Request {request_id} does not belong to API key {api_string}.'}), 401)
+    page, page_state = get_page_and_page_state(request_id, page_name)
+    if not page:
+        return page_name, extension, (jsonify({
+            'status': 'failure',
+            'message': f'Page {page_name} does not exist.'}), 404)
+    if page_state != PageState.CREATED:
+        return page_name, extension, (jsonify({
+            'status': 'failure',
+            'message': f'Page {page_name} is in {page_state.name} state. It should be in CREATED state.'}), 400)
+    if extension not in app.config['ALLOWED_IMAGE_EXTENSIONS']:
+        allowed_extesions = str(app.config["ALLOWED_IMAGE_EXTENSIONS"]).replace("\'", "")[1:-1]
+        return page_name, extension, (jsonify({
+            'status': 'failure',
+            'message': f'{extension} is not supported format. Supported formats are {allowed_extesions}.'}), 422)
+    return page_name, extension, None
+
+
+@bp.route('/upload_image_chunked/<string:request_id>/<string:file_name>', methods=['POST'])
+@require_user_api_key
+def start_chunked_image_upload(request_id, file_name):
+    page_name, extension, error = check_chunked_image_upload(request_id, file_name)
+    if error is not None:
+        return error
+
+    offset = start_image_upload(request_id, page_name, extension)
+    return jsonify({
+        'status': 'success',
+        'offset': offset,
+        'max_chunk_size': app.config['MAX_UPLOAD_CHUNK_SIZE']}), 200
+
+
+@bp.route('/upload_image_chunked/<string:request_id>/<string:file_name>', methods=['PUT'])
+@require_user_api_key
+def upload_image_chunk(request_id, file_name):
+    page_name, extension, error = check_chunked_image_upload(request_id, file_name)
+    if error is not None:
+        return error
+
+    offset = request.headers.get('upload-offset', default=None, type=int)
+    if offset is None:
+        return jsonify({
+            'status': 'failure',
+            'message': 'Header upload-offset is missing.'}), 400
+    if request.content_length is None or request.content_length > app.config['MAX_UPLOAD_CHUNK_SIZE']:
+        return jsonify({
+            'status': 'failure',
+            'message': f'Chunk size has to be given and at most {app.config["MAX_UPLOAD_CHUNK_SIZE"]} bytes.'}), 413
+
+    try:
+        offset = append_image_chunk(request_id, page_name, extension, offset, request.stream)
+    except FileNotFoundError:
+        return jsonify({
+            'status': 'failure',
+            'message': f'Upload of page {page_name} has not been started.'}), 404
+    except UploadOffsetMismatch as e:
+        return jsonify({
+            'status': 'failure',
+            'message': str(e),
+            'offset': e.offset}), 409
+
+    return jsonify({
+        'status': 'success',
+        'offset': offset}), 200
+
+
+@bp.route('/upload_image_chunked/<string:request_id>/<string:file_name>/finish', methods=['POST'])
+@require_user_api_key
+def finish_chunked_image_upload(request_id, file_name):
+    page_name, extension, error = check_chunked_image_upload(request_id, file_name)
+    if error is not None:
+        return error
+
+    sha256 = (request.get_json(silent=True) or {}).get('sha256')
+    if not isinstance(sha256, str):
+        return jsonify({
+            'status': 'failure',
+            'message': 'SHA-256 checksum of image is missing.'}), 400
+
+    try:
+        stored = finish_image_upload(request_id, page_name, extension, sha256)
+    except FileNotFoundError:
+        return jsonify({
+            'status': 'failure',
+            'message': f'Upload of page {page_name} has not been started.'}), 404
+    if not stored:
+        return jsonify({
+            'status': 'failure',
+            'message': 'Checksum does not match uploaded data. Upload has to be started again.'}), 422
+
+    o = urlparse(request.base_url)
+    path = f'{o.scheme}://{o.netloc}{app.config["APPLICATION_ROOT"]}/download_image/{request_id}/{page_name}.{extension}'
+    change_page_path(request_id, page_name, path)
+    return jsonify({
+        'status': 'success'}), 200
+
+
 @bp.route('/request_status/<string:request_id>', methods=['GET'])
 @require_user_api_key
 def request_status(request_id):
     api_string = request.headers.get('api-key')
-    if not request_exists(request_id):
+    request_ = request_exists(request_id)
+    if not request_:
         return jsonify({
             'status': 'failure',
             'message': f'Request {request_id} does not exist.'}), 404
 
-    if not request_belongs_to_api_key(request.headers.get('api-key'), request_id):
+    if not request_belongs_to_api_key(g.api_key.id, request_id):
         return jsonify({
             'status': 'failure',
             'message': f'Request {request_id} does not belong to API key {api_string}.'}), 401
 
+    request_summary = get_request_summary(request_)
+    if request.args.get('summary_only', default='false').lower() == 'true':
+        return jsonify({
+            'status': 'success',
+            'request_summary': request_summary}), 200
+
     pages = get_document_pages(request_id)
 
     return jsonify({
         'status': 'success',
+        'request_summary': request_summary,
         'request_status': {page.name: {'state': str(page.state).split('.')[1], 'quality': page.score} for page in pages}}), 200
 
 
@@ -142,7 +337,7 @@ def download_results(request_id, page_name, format):
         return jsonify({
             'status': 'failure',
             'message': f'Request {request_id} does not exist.'}), 404
-    if not request_belongs_to_api_key(request.headers.get('api-key'), request_id):
+    if not request_belongs_to_api_key(g.api_key.id, request_id):
         return jsonify({
             'status': 'failure',
             'message': f'Request {request_id} does not belong to API key {api_string}.'}), 401
@@ -159,40 +354,69 @@ def download_results(request_id, page_name, format):
         return jsonify({
             'status': 'failure',
             'message': f'Page {page_name} is not processed yet.'}), 404
-    if format not in ['alto', 'page', 'txt']:
+    if format not in RESULT_FORMATS:
         return jsonify({
             'status': 'failure',
             'message': 'Bad export format. Supported formats are alto, page, txt.'}), 400
 
-    try:
-        with FileLock(os.path.join(app.config['PROCESSED_REQUESTS_FOLDER'], str(page.request_id), str(page.request_id)+'_lock'), timeout=1):
-            archive = zipfile.ZipFile(os.path.join(app.config['PROCESSED_REQUESTS_FOLDER'], str(request_.id), str(request_.id)+'.zip'), 'r')
-            if format == 'alto':
-                data = archive.read('{}_alto.xml'.format(page.name))
-                extension = 'xml'
-            elif format == 'page':
-                data = archive.read('{}_page.xml'.format(page.name))
-                extension = 'xml'
-            elif format == 'txt':
-                data = archive.read('{}.txt'.format(page.name))
-                extension = 'txt'
-    except Timeout:
-        archive = zipfile.ZipFile(os.path.join(app.config['PROCESSED_REQUESTS_FOLDER'], str(request_.id), str(request_.id) + '.zip'), 'r')
-        if format == 'alto':
-            data = archive.read('{}_alto.xml'.format(page.name))
-            extension = 'xml'
-        elif format == 'page':
-            data = archive.read('{}_page.xml'.format(page.name))
-            extension = 'xml'
-        elif format == 'txt':
-            data = archive.read('{}.txt'.format(page.name))
-            extension = 'txt'
-
-    return send_file(BytesIO(data),
-                     attachment_filename='{}.{}'.format(page.name, extension),
+    result = open_page_result(request_.id, page.id, page.name, format)
+    if result is None:
+        return jsonify({
+            'status': 'failure',
+            'message': f'Results of page {page_name} have not been found.'}), 404
+    file, _ = result
+
+    return send_file(file,
+                     attachment_filename='{}.{}'.format(page.name, RESULT_FORMATS[format][1]),
                      as_attachment=True)
 
 
+@bp.route('/download_request_results/<string:request_id>', methods=['GET'])
+@require_user_api_key
+def download_request_results(request_id):
+    api_string = request.headers.get('api-key')
+    request_ = request_exists(request_id)
+    if not request_:
+        return jsonify({
+            'status': 'failure',
+            'message': f'Request {request_id} does not exist.'}), 404
+    if not request_belongs_to_api_key(g.api_key.id, request_id):
+        return jsonify({
+            'status': 'failure',
+            'message': f'Request {request_id} does not belong to API key {api_string}.'}), 401
+
+    formats = request.args.get('formats', default=','.join(RESULT_FORMATS)).split(',')
+    if any(format not in RESULT_FORMATS for format in formats):
+        return jsonify({
+            'status': 'failure',
+            'message': 'Bad export format. Supported formats are alto, page, txt.'}), 400
+    archive_format = request.args.get('archive', default='zip')
+    if archive_format not in ARCHIVE_FORMATS:
+        return jsonify({
+            'status': 'failure',
+            'message': 'Bad archive format. Supported formats are zip, tar.'}), 400
+    since = request.args.get('since', default=None)
+    if since is not None:
+        try:
+            since = datetime.datetime.fromisoformat(since)
+        except ValueError:
+            return jsonify({
+                'status': 'failure',
+                'message': 'Bad since timestamp. Timestamp should be in ISO 8601 format.'}), 400
+        # finish timestamps are naive UTC, timestamp with offset is converted to it
+        if since.tzinfo is not None:
+            since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    results_timestamp = datetime.datetime.utcnow()
+    pages = get_processed_pages(request_id, since)
+
+    response = Response(stream_with_context(stream_request_results(request_.id, pages, formats, archive_format)),
+                        mimetype=ARCHIVE_FORMATS[archive_format])
+    response.headers['Content-Disposition'] = f'attachment; filename={request_.id}.{archive_format}'
+    response.headers['results-timestamp'] = results_timestamp.isoformat()
+    return response
+
+
 @bp.route('/cancel_request/<string:request_id>', methods=['POST'])
 @require_user_api_key
 def cancel_request(request_id):
@@ -202,7 +426,7 @@ def cancel_request(request_id):
             'status': 'failure',
             'message': f'Request {request_id} does not exist.'}), 404
 
-    if not request_belongs_to_api_key(request.headers.get('api-key'), request_id):
+    if not request_belongs_to_api_key(g.api_key.id, request_id):
         return jsonify({
             'status': 'failure',
             'message': f'Request {request_id} does not belong to API key {api_string}.'}), 401
@@ -212,23 +436,83 @@ def cancel_request(request_id):
         'status': 'success'}), 200
 
 
+def parse_engine_ids(engine_ids):
+    """
+    @param engine_ids: comma separated engine IDs
+    @return: list of engine IDs, invalid values are skipped
+    """
+    return [int(engine_id) for engine_id in engine_ids.split(',') if engine_id.strip().isdecimal()]
+
+
 @bp.route('/get_processing_request/<int:preferred_engine_id>', methods=['GET'])
 @require_super_user_api_key
 def get_processing_request(preferred_engine_id):
-    page, engine_id = get_page_by_preferred_engine(preferred_engine_id)
+    wait = min(request.args.get('wait', default=0, type=float), app.config['MAX_PROCESSING_REQUEST_WAIT'])
+    loaded_engine_ids = parse_engine_ids(request.args.get('loaded_engines', default=''))
+    start = time.perf_counter()
+    page, engine_id = get_page_by_preferred_engine(preferred_engine_id, wait, loaded_engine_ids)
+    metrics.dispatch_wait.labels(leased='true' if page else 'false').observe(time.perf_counter() - start)
 
     if page:
         return jsonify({
             'status': 'success',
             'page_id': page.id,
             'page_url': page.url,
-            'engine_id': engine_id}), 200
+            'engine_id': engine_id,
+            'lease_duration': get_lease_duration(engine_id)}), 200
+    else:
+        return jsonify({
+            'status': 'failure',
+            'message': 'No page available for processing.'}), 204
+
+
+@bp.route('/get_processing_requests/<int:preferred_engine_id>/<int:page_count>', methods=['GET'])
+@require_super_user_api_key
+def get_processing_requests(preferred_engine_id, page_count):
+    page_count = min(page_count, app.config['MAX_LEASED_PAGES'])
+    wait = min(request.args.get('wait', default=0, type=float), app.config['MAX_PROCESSING_REQUEST_WAIT'])
+    loaded_engine_ids = parse_engine_ids(request.args.get('loaded_engines', default=''))
+    start = time.perf_counter()
+    pages, engine_id = wait_for_pages_by_preferred_engine(preferred_engine_id, page_count, wait, loaded_engine_ids)
+    metrics.dispatch_wait.labels(leased='true' if pages else 'false').observe(time.perf_counter() - start)
+
+    if pages:
+        return jsonify({
+            'status': 'success',
+            'pages': [{'page_id': page.id, 'page_url': page.url} for page in pages],
+            'engine_id': engine_id,
+            'lease_duration': get_lease_duration(engine_id)}), 200
     else:
         return jsonify({
             'status': 'failure',
             'message': 'No page available for processing.'}), 204
 
 
+@bp.route('/renew_page_leases', methods=['POST'])
+@require_super_user_api_key
+def renew_leases():
+    page_ids = (request.get_json(silent=True) or {}).get('page_ids')
+    if not isinstance(page_ids, list):
+        return jsonify({
+            'status': 'failure',
+            'message': 'List of page IDs is missing.'}), 400
+    if len(page_ids) > app.config['MAX_RENEWED_PAGE_LEASES']:
+        return jsonify({
+            'status': 'failure',
+            'message': f'Too many pages. Maximal number of pages is {app.config["MAX_RENEWED_PAGE_LEASES"]}.'}), 413
+
+    try:
+        renewed = renew_page_leases(page_ids)
+    except sqlalchemy.exc.StatementError:
+        return jsonify({
+            'status': 'failure',
+            'message': 'Bad page ID.'}), 400
+
+    return jsonify({
+        'status': 'success',
+        'renewed': renewed}), 200
+
+
 @bp.route('/upload_results/<string:page_id>', methods=['POST'])
 @require_super_user_api_key
 def upload_results(page_id):
@@ -246,19 +530,13 @@ def upload_results(page_id):
 
     check_save_path(page.request_id)
 
-    try:
-        with FileLock(os.path.join(app.config['PROCESSED_REQUESTS_FOLDER'], str(page.request_id), str(page.request_id)+'_lock'), timeout=5):
-            with zipfile.ZipFile(os.path.join(app.config['PROCESSED_REQUESTS_FOLDER'], str(page.request_id), str(page.request_id)+'.zip'), 'a', zipfile.ZIP_DEFLATED) as zipf:
-                zipf.writestr(page.name + '_alto.xml', request.files['alto'].read())
-                zipf.writestr(page.name + '_page.xml', request.files['page'].read())
-                zipf.writestr(page.name + '.txt', request.files['txt'].read())
-    except Timeout:
-        with zipfile.ZipFile(os.path.join(app.config['PROCESSED_REQUESTS_FOLDER'], str(page.request_id), str(page.request_id) + '.zip'), 'a', zipfile.ZIP_DEFLATED) as zipf:
-            zipf.writestr(page.name + '_alto.xml', request.files['alto'].read())
-            zipf.writestr(page.name + '_page.xml', request.files['page'].read())
-            zipf.writestr(page.name + '.txt', request.files['txt'].read())
+    with metrics.result_store_write.time():
+        for format in RESULT_FORMATS:
+            save_page_result(page.request_id, page.id, format, request.files[format].read())
 
     change_page_to_processed(page_id, score, engine_version.id)
+    if request.headers.get('timings') is not None:
+        metrics.record_client_timings(request.headers.get('timings'), engine.name, engine_version_str)
 
     # remove image if exists
     extension = page.url.split('.')[-1]
@@ -272,6 +550,23 @@ def upload_results(page_id):
         'status': 'success'}), 200
 
 
+@bp.route('/get_engine_version/<int:engine_id>', methods=['GET'])
+@require_super_user_api_key
+def get_engine_version_info(engine_id):
+    engine = get_engine(engine_id)
+    if not engine:
+        return jsonify({
+            'status': 'failure',
+            'message': f'Engine {engine_id} has not been found.'}), 404
+    engine_version = get_latest_engine_version(engine_id)
+
+    return jsonify({
+        'status': 'success',
+        'engine_id': engine.id,
+        'engine_name': engine.name,
+        'engine_version': engine_version.version}), 200
+
+
 @bp.route('/download_engine/<int:engine_id>', methods=['GET'])
 @require_super_user_api_key
 def download_engine(engine_id):
@@ -282,44 +577,26 @@ def download_engine(engine_id):
             'message': f'Engine {engine_id} has not been found.'}), 404
     engine_version, models = get_latest_models(engine_id)
 
-    if len(models) == 2:
-        engine_config = ('[PAGE_PARSER]\n'
-                         'RUN_LAYOUT_PARSER = yes\n'
-                         'RUN_LINE_CROPPER = yes\n'
-                         'RUN_OCR = yes\n'
-                         'RUN_DECODER = no\n'
-                         '\n\n')
-    elif len(models) == 3:
-        engine_config = ('[PAGE_PARSER]\n'
-                         'RUN_LAYOUT_PARSER = yes\n'
-                         'RUN_LINE_CROPPER = yes\n'
-                         'RUN_OCR = yes\n'
-                         'RUN_DECODER = yes\n'
-                         '\n\n')
-    else:
-        if not engine:
-            return jsonify({
-                'status': 'failure',
-                'message': 'Too many models for engine.'}), 500
-
-    memory_file = BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for model in models:
-            for root, dirs, files in os.walk(os.path.join(app.config['MODELS_FOLDER'], model.name)):
-                for file in files:
-                    zf.write(os.path.join(root, file), os.path.join(model.name, file))
-            engine_config += model.config + '\n\n'
-        zf.writestr('config.ini', engine_config)
-    memory_file.seek(0)
+    cached = os.path.isfile(get_engine_bundle_path(app.config['ENGINE_BUNDLES_FOLDER'], engine_version.id))
+    try:
+        with metrics.engine_bundle_build.labels(cached='true' if cached else 'false').time():
+            bundle_path = build_engine_bundle(models, app.config['MODELS_FOLDER'],
+                                              app.config['ENGINE_BUNDLES_FOLDER'], engine_version.id)
+    except ValueError:
+        return jsonify({
+            'status': 'failure',
+            'message': 'Too many models for engine.'}), 500
 
-    return send_file(memory_file, attachment_filename='{}#{}.zip'.format(engine.name, engine_version.version), as_attachment=True)
+    # bundle of engine version never changes, ETag and Range requests are handled by send_file
+    return send_file(bundle_path,
+                     attachment_filename='{}#{}.zip'.format(engine.name, engine_version.version),
+                     as_attachment=True,
+                     conditional=True)
 
 
 @bp.route('/failed_processing/<string:page_id>', methods=['POST'])
 @require_super_user_api_key
 def report_failed_processing(page_id):
-    notification_timestamp = get_notification()
-
     fail_type = str(request.headers.get('type'))
     traceback = str(request.data)
     engine_version_str = str(request.headers.get('engine_version'))
@@ -330,44 +607,36 @@ def report_failed_processing(page_id):
     change_page_to_failed(page_id, fail_type, traceback, engine_version.id)
 
     if fail_type == "PROCESSING_FAILED" and app.config['EMAIL_NOTIFICATION_ADDRESSES'] != []:
-        print(datetime.datetime.now(), notification_timestamp, (datetime.datetime.now() - notification_timestamp).total_seconds(), app.config["MAX_EMAIL_FREQUENCY"])
-        if (datetime.datetime.now() - notification_timestamp).total_seconds() > app.config["MAX_EMAIL_FREQUENCY"]:
-            page_db = get_page_by_id(page_id)
-            request_db = get_request_by_page(page_db)
-            api_key_db = get_api_key_by_id(request_db.api_key_id)
-
-            message_body = "processing_client_hostname: {}<br>" \
-                           "processing_client_ip_address: {}<br>" \
-                           "owner_api_key: {}<br>" \
-                           "owner_description: {}<br>" \
-                           "engine_id: {}<br>" \
-                           "engine_name: {}<br>" \
-                           "request_id: {}<br>" \
-                           "page_id: {}<br>" \
-                            "page_name: {}<br>" \
-                           "page_url: {}<br>" \
-                           "####################<br>" \
-                           "traceback:<br>{}" \
-                           .format(request.headers.get('hostname'),
-                                   request.headers.get('ip-address'),
-                                   api_key_db.api_string,
-                                   api_key_db.owner,
-                                   engine.id,
-                                   engine.name,
-                                   request_db.id,
-                                   page_db.id,
-                                   page_db.name,
-                                   page_db.url,
-                                   traceback.replace("\n", "<br>"))
-
-            send_mail(subject="API Bot - PROCESSING_FAILED",
-                      body=message_body,
-                      sender=('PERO OCR - API BOT', app.config['MAIL_USERNAME']),
-                      recipients=app.config['EMAIL_NOTIFICATION_ADDRESSES'],
-                      host=app.config['MAIL_SERVER'],
-                      password=app.config['MAIL_PASSWORD'])
-
-            set_notification()
+        page_db = get_page_by_id(page_id)
+        request_db = get_request_by_page(page_db)
+        api_key_db = get_api_key_by_id(request_db.api_key_id)
+
+        message_body = "processing_client_hostname: {}<br>" \
+                       "processing_client_ip_address: {}<br>" \
+                       "owner_api_key: {}<br>" \
+                       "owner_description: {}<br>" \
+                       "engine_id: {}<br>" \
+                       "engine_name: {}<br>" \
+                       "request_id: {}<br>" \
+                       "page_id: {}<br>" \
+                       "page_name: {}<br>" \
+                       "page_url: {}<br>" \
+                       "####################<br>" \
+                       "traceback:<br>{}<br>" \
+                       "####################<br>" \
+                       .format(request.headers.get('hostname'),
+                               request.headers.get('ip-address'),
+                               api_key_db.api_string,
+                               api_key_db.owner,
+                               engine.id,
+                               engine.name,
+                               request_db.id,
+                               page_db.id,
+                               page_db.name,
+                               page_db.url,
+                               traceback.replace("\n", "<br>"))
+
+        notification_queue.notify("API Bot - PROCESSING_FAILED", message_body)
 
     return jsonify({
         'status': 'success'}), 200
@@ -376,7 +645,12 @@ def report_failed_processing(page_id):
 @bp.route('/page_statistics', methods=['GET'])
 @require_super_user_api_key
 def page_statistics():
-    state_stats, engine_stats = get_page_statistics()
+    history_hours = request.args.get('history_hours', default=app.config['PAGE_STATISTICS_HISTORY_HOURS'], type=int)
+    if not 0 < history_hours <= app.config['MAX_PAGE_STATISTICS_HISTORY_HOURS']:
+        return jsonify({
+            'status': 'failure',
+            'message': f'History has to be between 1 and {app.config["MAX_PAGE_STATISTICS_HISTORY_HOURS"]} hours.'}), 400
+    state_stats, engine_stats = get_page_statistics(history_hours)
 
     return jsonify({
         'status': 'success',
@@ -384,6 +658,12 @@ def page_statistics():
         'engine_stats': engine_stats}), 200
 
 
+@bp.route('/metrics', methods=['GET'])
+@metrics.require_metrics_access
+def get_metrics():
+    return Response(metrics.render(get_engine_queue_metrics()), content_type=metrics.CONTENT_TYPE_LATEST)
+
+
 @bp.route('/download_image/<string:request_id>/<string:page_name>', methods=['GET'])
 @require_super_user_api_key
 def download_image(request_id, page_name):
@@ -416,12 +696,6 @@ def download_image(request_id, page_name):
 
 @bp.errorhandler(500)
 def handle_exception(e):
-    if app.config['EMAIL_NOTIFICATION_ADDRESSES'] != []:
-        send_mail(subject="API Bot - INTERNAL SERVER ERROR",
-                  body=traceback.format_exc().replace("\n", "<br>"),
-                  sender=('PERO OCR - API BOT', app.config['MAIL_USERNAME']),
-                  recipients=app.config['EMAIL_NOTIFICATION_ADDRESSES'],
-                  host=app.config['MAIL_SERVER'],
-                  password=app.config['MAIL_PASSWORD'])
+    notification_queue.notify("API Bot - INTERNAL SERVER ERROR", traceback.format_exc().replace("\n", "<br>"))
 
     abort(500)
@@ -0,0 +1,171 @@
+import os
+import shutil
+import tarfile
+import zipfile
+import hashlib
+import tempfile
+from filelock import FileLock
+
+from flask import current_app as app
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadOffsetMismatch(Exception):
+    def __init__(self, offset):
+        super(UploadOffsetMismatch, self).__init__(f'Upload continues at offset {offset}.')
+        self.offset = offset
+
+
+class ArchiveTooLarge(Exception):
+    def __init__(self, max_size):
+        super(ArchiveTooLarge, self).__init__(f'Archive is larger than {max_size} bytes.')
+        self.max_size = max_size
+
+
+class SizeLimitedStream(object):
+    """
+    Reads stream and raises ArchiveTooLarge when more than max_size bytes are read, so archive sent without
+    content length cannot fill the disk.
+    """
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise ArchiveTooLarge(self.max_size)
+        return data
+
+
+def get_request_images_path(request_id):
+    return os.path.join(app.config['UPLOAD_IMAGES_FOLDER'], str(request_id))
+
+
+def get_image_path(request_id, page_name, extension):
+    return os.path.join(get_request_images_path(request_id), '{}.{}'.format(page_name, extension))
+
+
+def get_image_part_path(request_id, page_name, extension):
+    return get_image_path(request_id, page_name, extension) + '.part'
+
+
+def start_image_upload(request_id, page_name, extension):
+    """
+    Creates partial image file unless it already exists, upload of existing file is resumed.
+    @return: offset at which the upload continues
+    """
+    os.makedirs(get_request_images_path(request_id), exist_ok=True)
+    part_path = get_image_part_path(request_id, page_name, extension)
+    with FileLock(part_path + '.lock'):
+        with open(part_path, 'ab'):
+            pass
+        return os.path.getsize(part_path)
+
+
+def append_image_chunk(request_id, page_name, extension, offset, stream):
+    """
+    Appends chunk read from stream to partial image file. Chunk is accepted only at the current end of the file,
+    so repeated or reordered chunks never corrupt the image.
+    @return: offset at which the upload continues
+    """
+    part_path = get_image_part_path(request_id, page_name, extension)
+    with FileLock(part_path + '.lock'):
+        if not os.path.isfile(part_path):
+            raise FileNotFoundError(part_path)
+        size = os.path.getsize(part_path)
+        if offset != size:
+            raise UploadOffsetMismatch(size)
+        with open(part_path, 'ab') as f:
+            while True:
+                data = stream.read(CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+        return os.path.getsize(part_path)
+
+
+def finish_image_upload(request_id, page_name, extension, sha256):
+    """
+    Checks checksum of partial image file and renames it to the final image path. Partial file with wrong checksum
+    is removed, so the upload has to start again. Lock file of the upload is removed together with the partial file.
+    @return: True if checksum matched and image was stored
+    """
+    part_path = get_image_part_path(request_id, page_name, extension)
+    lock_path = part_path + '.lock'
+    with FileLock(lock_path):
+        if not os.path.isfile(part_path):
+            raise FileNotFoundError(part_path)
+        checksum = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+                checksum.update(data)
+
+        stored = checksum.hexdigest() == sha256.lower()
+        if stored:
+            os.replace(part_path, get_image_path(request_id, page_name, extension))
+        else:
+            os.remove(part_path)
+
+    # request waiting for the removed lock finds no partial file, new upload starts with a new lock file
+    try:
+        os.remove(lock_path)
+    except FileNotFoundError:
+        pass
+    return stored
+
+
+def save_image(request_id, page_name, extension, file):
+    """
+    Copies image from file object to its final path under temporary name and renames it, so an interrupted upload
+    never leaves a partially written image.
+    """
+    path = get_image_path(request_id, page_name, extension)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(file, f, CHUNK_SIZE)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def extract_image_archive(request_id, stream, archive_format, page_names):
+    """
+    Extracts images of pages from tar or zip archive. Tar archive is read as a stream, zip archive needs random access
+    and is spooled into temporary file first. Image is matched to page by its file name without extension,
+    directories in archive are ignored. Reading more than MAX_IMAGE_ARCHIVE_SIZE bytes raises ArchiveTooLarge.
+    @param page_names: names of pages waiting for images
+    @return: generator of (archive member name, page name, extension), page name is None for skipped member
+    """
+    os.makedirs(get_request_images_path(request_id), exist_ok=True)
+    stream = SizeLimitedStream(stream, app.config['MAX_IMAGE_ARCHIVE_SIZE'])
+
+    def extract(member_name, open_member):
+        page_name, extension = os.path.splitext(os.path.basename(member_name))
+        extension = extension[1:].lower()
+        if page_name not in page_names or extension not in app.config['ALLOWED_IMAGE_EXTENSIONS']:
+            return member_name, None, None
+        with open_member() as file:
+            save_image(request_id, page_name, extension, file)
+        return member_name, page_name, extension
+
+    if archive_format == 'tar':
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield extract(member.name, lambda: archive.extractfile(member))
+    else:
+        with tempfile.TemporaryFile() as spooled:
+            shutil.copyfileobj(stream, spooled, CHUNK_SIZE)
+            spooled.seek(0)
+            with zipfile.ZipFile(spooled) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        yield extract(info.filename, lambda: archive.open(info))
@@ -0,0 +1,153 @@
+import os
+import hmac
+import json
+import time
+from functools import wraps
+
+from flask import g, request, abort, current_app, has_request_context
+from sqlalchemy import event
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+# upload of results is still running when the timings are sent, so it is reported only in client timing log
+CLIENT_STAGES = {'download', 'decode', 'process_page', 'alto', 'arabic', 'page_xml'}
+
+
+# Metrics of one server process. When PROMETHEUS_MULTIPROC_DIR environment variable is set, prometheus_client stores
+# the values in files in the directory and /metrics of any server process reports values aggregated over all of them.
+registry = CollectorRegistry()
+
+http_requests = Counter(
+    'pero_http_requests', 'Number of handled HTTP requests.', ['method', 'route', 'status'], registry=registry)
+http_request_duration = Histogram(
+    'pero_http_request_duration_seconds', 'Time of handling HTTP request.', ['method', 'route'],
+    buckets=DEFAULT_BUCKETS, registry=registry)
+http_request_db_queries = Histogram(
+    'pero_http_request_db_queries', 'Number of database queries executed by HTTP request.', ['route'],
+    buckets=QUERY_COUNT_BUCKETS, registry=registry)
+db_queries = Counter(
+    'pero_db_queries', 'Number of executed database queries.', registry=registry)
+dispatch_wait = Histogram(
+    'pero_dispatch_wait_seconds', 'Time processing client waited for leased pages.', ['leased'],
+    buckets=DEFAULT_BUCKETS, registry=registry)
+result_store_write = Histogram(
+    'pero_result_store_write_seconds', 'Time of writing results of one page to result store.',
+    buckets=DEFAULT_BUCKETS, registry=registry)
+engine_bundle_build = Histogram(
+    'pero_engine_bundle_build_seconds', 'Time of building engine bundle, prebuilt bundles are labeled cached.',
+    ['cached'], buckets=DEFAULT_BUCKETS, registry=registry)
+client_stage_duration = Histogram(
+    'pero_client_stage_seconds', 'Duration of page processing stage reported by processing client.',
+    ['engine', 'engine_version', 'stage'], buckets=DEFAULT_BUCKETS + (120.0, 300.0), registry=registry)
+
+
+class EngineQueueCollector(object):
+    """
+    Queue depth and lease age per engine, computed from the database at scrape time.
+    """
+
+    def __init__(self, queues):
+        """
+        @param queues: dictionary {engine_id: (waiting pages, processing pages, oldest lease age in seconds)}
+        """
+        self.queues = queues
+
+    def collect(self):
+        gauges = [GaugeMetricFamily('pero_waiting_pages', 'Number of pages waiting for processing.',
+                                    labels=['engine']),
+                  GaugeMetricFamily('pero_processing_pages', 'Number of pages leased to processing clients.',
+                                    labels=['engine']),
+                  GaugeMetricFamily('pero_lease_age_max_seconds',
+                                    'Age of the oldest page lease since its last renewal.', labels=['engine'])]
+        for engine_id, queue in sorted(self.queues.items()):
+            for gauge, value in zip(gauges, queue):
+                gauge.add_metric([str(engine_id)], value)
+        return gauges
+
+
+def render(queues):
+    """
+    @param queues: engine queue metrics, see EngineQueueCollector
+    @return: metrics in Prometheus text format
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        process_registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(process_registry)
+    else:
+        process_registry = registry
+
+    queue_registry = CollectorRegistry()
+    queue_registry.register(EngineQueueCollector(queues))
+    return generate_latest(process_registry) + generate_latest(queue_registry)
+
+
+def require_metrics_access(f):
+    """
+    Allows scraping by bearer token METRICS_TOKEN or from addresses in METRICS_ALLOWED_IPS.
+    @param f: flask function
+    @return: decorator, return the wrapped function or abort json object.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = current_app.config['METRICS_TOKEN']
+        authorization = request.headers.get('Authorization', '')
+        if token and hmac.compare_digest(authorization.encode('utf-8'), f'Bearer {token}'.encode('utf-8')):
+            return f(*args, **kwargs)
+        if request.remote_addr in current_app.config['METRICS_ALLOWED_IPS']:
+            return f(*args, **kwargs)
+        abort(401, 'Metrics require valid bearer token or allowed address.')
+    return decorated
+
+
+def count_db_query(conn, cursor, statement, parameters, context, executemany):
+    db_queries.inc()
+    if has_request_context():
+        g.metrics_db_queries = g.get('metrics_db_queries', 0) + 1
+
+
+def start_request_timer():
+    g.metrics_start_time = time.perf_counter()
+    g.metrics_db_queries = 0
+
+
+def store_response_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def record_request(exception):
+    """
+    Called on teardown, so requests failing with unhandled exception are recorded as well.
+    """
+    if 'metrics_start_time' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        # response of failed request is not passed to after_request handlers when exceptions are propagated
+        status = g.get('metrics_status', 500)
+        http_requests.labels(method=request.method, route=route, status=str(status)).inc()
+        http_request_duration.labels(method=request.method, route=route)\
+                             .observe(time.perf_counter() - g.metrics_start_time)
+        http_request_db_queries.labels(route=route).observe(g.metrics_db_queries)
+
+
+def record_client_timings(timings, engine, engine_version):
+    """
+    @param timings: JSON dictionary {stage: seconds} sent by processing client, unknown stages are ignored
+    """
+    try:
+        timings = json.loads(timings)
+        for stage, seconds in timings.items():
+            if stage in CLIENT_STAGES:
+                client_stage_duration.labels(engine=engine, engine_version=engine_version, stage=stage)\
+                                     .observe(float(seconds))
+    except (ValueError, TypeError, AttributeError):
+        pass
+
+
+def init_metrics(app, db_engine):
+    app.before_request(start_request_timer)
+    app.after_request(store_response_status)
+    app.teardown_request(record_request)
+    event.listen(db_engine, 'before_cursor_execute', count_db_query)
@@ -0,0 +1,90 @@
+import time
+import uuid
+import select
+import threading
+import traceback
+
+from sqlalchemy import text
+
+
+CHANNEL = 'waiting_pages'
+LISTEN_TIMEOUT = 60
+LISTEN_RETRY_INTERVAL = 10
+
+
+class WaitingPagesNotifier(object):
+    """
+    Wakes up processing clients waiting for new WAITING pages. On PostgreSQL notifications are passed to all server
+    processes by LISTEN/NOTIFY, otherwise they are delivered only inside one server process. Waiting clients also
+    recheck the database every PROCESSING_REQUEST_RECHECK_INTERVAL seconds in case some notification was lost.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.instance_id = uuid.uuid4().hex
+        self.db_engine = None
+        self.thread = None
+
+    def start(self, db_engine):
+        """
+        Starts listening to notifications of other server processes, does nothing on other databases than PostgreSQL.
+        """
+        with self.condition:
+            if db_engine.dialect.name != 'postgresql' or self.thread is not None:
+                return
+            self.db_engine = db_engine
+            self.thread = threading.Thread(target=self.listen, daemon=True)
+            self.thread.start()
+
+    def notify(self):
+        self.notify_local()
+        if self.db_engine is not None:
+            try:
+                with self.db_engine.connect() as connection:
+                    connection.execute(text(f"NOTIFY {CHANNEL}, '{self.instance_id}'")
+                                       .execution_options(autocommit=True))
+            except Exception:
+                traceback.print_exc()
+
+    def notify_local(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """
+        Blocks until notify is called after generation was read or until timeout.
+        @return: current generation
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout=timeout)
+            return self.generation
+
+    def listen(self):
+        while True:
+            connection = None
+            try:
+                # connection is taken from the pool for good, it is never returned in LISTEN state
+                connection = self.db_engine.raw_connection()
+                dbapi_connection = connection.connection
+                dbapi_connection.autocommit = True
+                cursor = dbapi_connection.cursor()
+                cursor.execute(f'LISTEN {CHANNEL}')
+                cursor.close()
+                while True:
+                    select.select([dbapi_connection], [], [], LISTEN_TIMEOUT)
+                    dbapi_connection.poll()
+                    # notifications sent by this process were already delivered by notify_local
+                    foreign = [n for n in dbapi_connection.notifies if n.payload != self.instance_id]
+                    dbapi_connection.notifies.clear()
+                    if foreign:
+                        self.notify_local()
+            except Exception:
+                traceback.print_exc()
+                if connection is not None:
+                    connection.invalidate()
+                time.sleep(LISTEN_RETRY_INTERVAL)
+
+
+waiting_pages_notifier = WaitingPagesNotifier()
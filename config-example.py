@@ -4,12 +4,44 @@ class Config(object):
     DEBUG = False
     PROCESSED_REQUESTS_FOLDER = 'C:/Users/LachubCz_NTB/Documents/GitHub/PERO-API/processed_requests'
     MODELS_FOLDER = 'C:/Users/LachubCz_NTB/Documents/GitHub/PERO-API/models'
+    ENGINE_BUNDLES_FOLDER = 'C:/Users/LachubCz_NTB/Documents/GitHub/PERO-API/engine_bundles'
     UPLOAD_IMAGES_FOLDER = 'C:/Users/LachubCz_NTB/Documents/GitHub/PERO-API/images'
     ALLOWED_IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png'}
+    MAX_UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+    MAX_IMAGE_ARCHIVE_SIZE = 4 * 1024 * 1024 * 1024
+    API_KEY_CACHE_INVALIDATION_FILE = 'C:/Users/LachubCz_NTB/Documents/GitHub/PERO-API/api_keys.stamp'
     APPLICATION_ROOT = ''
 
+    MAX_PROCESSING_REQUEST_SIZE = 64 * 1024 * 1024
+    PAGE_INSERT_BATCH_SIZE = 1000
+    MAX_REQUEST_PRIORITY = 10
+
+    API_KEY_CACHE_TTL = 60
+    API_KEY_CACHE_SIZE = 10000
+
+    MAX_LEASED_PAGES = 32
+    MAX_PROCESSING_REQUEST_WAIT = 30
+    PROCESSING_REQUEST_RECHECK_INTERVAL = 15
+    ENGINE_SWITCH_MIN_BACKLOG_PER_PAGE = 10
+    ENGINE_SWITCH_MAX_WAIT = 60
+    DISPATCH_STATISTICS_CACHE_TIME = 2
+    PAGE_LEASE_DURATION = 60
+    MAX_RENEWED_PAGE_LEASES = 1000
+    REAPER_BATCH_SIZE = 1000
+
+    PAGE_STATISTICS_HISTORY_HOURS = 24
+    MAX_PAGE_STATISTICS_HISTORY_HOURS = 24 * 30
+    PAGE_STATISTICS_CACHE_TIME = 10
+
+    # /metrics is available with header 'Authorization: Bearer METRICS_TOKEN' or from METRICS_ALLOWED_IPS
+    METRICS_TOKEN = ''
+    METRICS_ALLOWED_IPS = ['127.0.0.1']
+
     EMAIL_NOTIFICATION_ADDRESSES = ["example1@google.com", "example2@google.com"]
     MAX_EMAIL_FREQUENCY = 3600
+    MAX_NOTIFICATION_DIGEST_SIZE = 100
+    MAX_NOTIFICATION_PAGES_PER_REQUEST = 10
+    NOTIFICATION_CHECK_INTERVAL = 60
 
     MAIL_SERVER = 'smtp.gmail.com'
     MAIL_USERNAME = ''
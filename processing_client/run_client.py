@@ -2,15 +2,20 @@ import os
 import re
 import cv2
 import sys
+import json
 import time
+import queue
 import socket
 import zipfile
 import requests
 import argparse
+import threading
+import multiprocessing
 import traceback
 import numpy as np
 import configparser
 from urllib.request import Request, urlopen
+from collections import OrderedDict
 from pathlib import Path
 
 from pero_ocr.document_ocr.page_parser import PageParser
@@ -18,6 +23,7 @@ from pero_ocr.document_ocr.layout import PageLayout, create_ocr_processing_eleme
 from pero_ocr.document_ocr.arabic_helper import ArabicHelper
 
 from helper import join_url
+from timing import PageTiming, TimingReport
 
 
 def get_args():
@@ -35,36 +41,190 @@ def get_args():
     parser.add_argument("--time-limit", default=-1, type=float, help="Exit when runing longer than time-limit hours.")
     parser.add_argument("--min-confidence", default=0.66, type=float,
                         help="Lines with lower confidence will be discarded.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Download, process and upload pages concurrently in separate stages.")
+    parser.add_argument("--prefetch", default=4, type=int,
+                        help="Number of downloaded pages waiting for processing in pipeline mode.")
+    parser.add_argument("--lease-size", default=4, type=int,
+                        help="Number of pages leased from server by one request in pipeline mode.")
+    parser.add_argument("--wait", default=0, type=float,
+                        help="Seconds the server should hold request for page open when no page is available.")
+    parser.add_argument("--engine-cache-size", default=1, type=int,
+                        help="Number of engines kept loaded in memory for switching between engines, every loaded "
+                             "engine takes its own GPU and host memory.")
+    parser.add_argument("--workers", default=0, type=int,
+                        help="Number of OCR processes fed by one supervisor process, which leases pages, downloads "
+                             "engines and uploads results.")
+    parser.add_argument("--timing-log", default=None,
+                        help="Path of JSON lines file with durations of processing stages of every page.")
+    parser.add_argument("--timing-window", default=100, type=int,
+                        help="Number of last pages used for rolling timing summary.")
+    parser.add_argument("--timing-interval", default=60, type=float,
+                        help="Seconds between printed timing summaries, 0 disables them.")
+    parser.add_argument("--send-timings", action="store_true",
+                        help="Send durations of processing stages except upload to server together with results.")
 
     args = parser.parse_args()
 
     return args
 
 
-def get_engine(config, headers, engine_id):
-    r = requests.get(join_url(config['SERVER']['base_url'],
-                              config['SERVER']['get_download_engine'],
-                              str(engine_id)),
-                     headers=headers)
+class EngineCache(object):
+    """
+    Keeps up to size loaded engines (PageParser instances), so switching between few engines does not load them again.
+    """
+
+    def __init__(self, config, headers, size):
+        self.config = config
+        self.headers = headers
+        self.size = max(size, 1)
+        self.engines = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, engine_id):
+        """
+        Returns latest version of engine, downloads it when it is not in engines_path.
+        @return: PageParser, engine name and engine version
+        """
+        engine_path, engine_name, engine_version = download_engine(self.config, self.headers, engine_id)
+        return self.load(engine_id, engine_path), engine_name, engine_version
+
+    def load(self, engine_id, engine_path):
+        with self.lock:
+            if engine_path in self.engines:
+                self.engines.move_to_end(engine_path)
+                return self.engines[engine_path][1]
+
+        page_parser = load_engine(engine_path)
+        with self.lock:
+            self.engines[engine_path] = (int(engine_id), page_parser)
+            while len(self.engines) > self.size:
+                self.engines.popitem(last=False)
+        return page_parser
+
+    def loaded_engine_ids(self):
+        """
+        Engines are reported to server, which prefers their pages over switching client to another engine.
+        """
+        with self.lock:
+            return [engine_id for engine_id, _ in self.engines.values()]
+
+
+class LeaseKeeper(object):
+    """
+    Renews leases of pages held by processing client from background thread, so server does not return pages
+    processed longer than lease duration to other clients. Leases of all held pages are renewed by one request.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.headers = {'api-key': config['SETTINGS']['api_key']}
+        self.lease_durations = dict()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def add(self, page_ids, lease_duration):
+        with self.lock:
+            for page_id in page_ids:
+                self.lease_durations[page_id] = lease_duration
+
+    def remove(self, page_id):
+        with self.lock:
+            self.lease_durations.pop(page_id, None)
+
+    def run(self):
+        last_renewal = time.time()
+        with requests.Session() as session:
+            while not self.stopped.wait(1):
+                with self.lock:
+                    page_ids = list(self.lease_durations)
+                    if not page_ids:
+                        continue
+                    # lease is renewed three times per its duration, so one lost heartbeat does not lose the page
+                    interval = min(self.lease_durations.values()) / 3
+                if time.time() - last_renewal < interval:
+                    continue
+
+                last_renewal = time.time()
+                # any error is only logged, the thread has to keep renewing leases until the client stops
+                try:
+                    r = session.post(join_url(self.config['SERVER']['base_url'],
+                                              self.config['SERVER'].get('post_renew_page_leases',
+                                                                        '/renew_page_leases')),
+                                     json={'page_ids': page_ids},
+                                     headers=self.headers)
+                    if r.status_code != 200:
+                        print(f'ERROR: Renewal of {len(page_ids)} page leases failed: {r.status_code} {r.text}')
+                except Exception:
+                    traceback.print_exc()
+
+
+def get_engine_version(config, headers, engine_id):
+    """
+    @return: engine name and latest engine version, None if server did not answer
+    """
+    try:
+        r = requests.get(join_url(config['SERVER']['base_url'],
+                                  config['SERVER']['get_engine_version'],
+                                  str(engine_id)),
+                         headers=headers)
+    except requests.exceptions.ConnectionError:
+        return None
+
+    if r.status_code == 200:
+        engine_info = r.json()
+        return engine_info['engine_name'], engine_info['engine_version']
+    return None
 
-    d = r.headers['content-disposition']
-    filename = re.findall("filename=(.+)", d)[0]
-    engine_name = filename[:-4].split('#')[0]
-    engine_version = filename[:-4].split('#')[1]
-    if not os.path.exists(os.path.join(config["SETTINGS"]['engines_path'], filename[:-4])):
-        os.mkdir(os.path.join(config["SETTINGS"]['engines_path'], filename[:-4]))
-        with open(os.path.join(config["SETTINGS"]['engines_path'], filename[:-4], filename), 'wb') as f:
-            f.write(r.content)
-        with zipfile.ZipFile(os.path.join(config["SETTINGS"]['engines_path'], filename[:-4], filename), 'r') as f:
-            f.extractall(os.path.join(config["SETTINGS"]['engines_path'], filename[:-4]))
 
+def download_engine(config, headers, engine_id):
+    """
+    Downloads and extracts latest version of engine into engines_path unless it is already there.
+    @return: path to extracted engine, engine name and engine version
+    """
+    engine_info = get_engine_version(config, headers, engine_id)
+    if engine_info is not None:
+        engine_name, engine_version = engine_info
+        engine_path = os.path.join(config["SETTINGS"]['engines_path'], '{}#{}'.format(engine_name, engine_version))
+        if os.path.isfile(os.path.join(engine_path, 'config.ini')):
+            return engine_path, engine_name, engine_version
+
+    with requests.get(join_url(config['SERVER']['base_url'],
+                               config['SERVER']['get_download_engine'],
+                               str(engine_id)),
+                      headers=headers,
+                      stream=True) as r:
+        d = r.headers['content-disposition']
+        filename = re.findall("filename=(.+)", d)[0]
+        engine_name = filename[:-4].split('#')[0]
+        engine_version = filename[:-4].split('#')[1]
+        engine_path = os.path.join(config["SETTINGS"]['engines_path'], filename[:-4])
+        # config.ini is the last file of engine archive, engine without it was not extracted completely
+        if not os.path.isfile(os.path.join(engine_path, 'config.ini')):
+            os.makedirs(engine_path, exist_ok=True)
+            with open(os.path.join(engine_path, filename), 'wb') as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+            with zipfile.ZipFile(os.path.join(engine_path, filename), 'r') as f:
+                f.extractall(engine_path)
+
+    return engine_path, engine_name, engine_version
+
+
+def load_engine(engine_path):
     engine_config = configparser.ConfigParser()
-    engine_config.read(os.path.join(config["SETTINGS"]['engines_path'], filename[:-4], 'config.ini'))
-    page_parser = PageParser(engine_config,
-                             config_path=os.path.dirname(os.path.join(config["SETTINGS"]['engines_path'],
-                                                                      filename[:-4],
-                                                                      'config.ini')))
-    return page_parser, engine_name, engine_version
+    engine_config.read(os.path.join(engine_path, 'config.ini'))
+    page_parser = PageParser(engine_config, config_path=engine_path)
+    return page_parser
 
 
 def get_page_layout_text(page_layout):
@@ -85,29 +245,462 @@ def get_score(page_layout):
         return np.quantile(line_quantiles, .50)
 
 
-def main():
-    args = get_args()
+def get_processing_pages(session, config, headers, engine_id, page_count, wait=0, loaded_engine_ids=()):
+    """
+    Leases up to page_count pages from server, server waits up to wait seconds for new pages.
+    @return: engine ID of leased pages, list of (page_id, page_url) tuples, None instead of list on error,
+             and lease duration of pages
+    """
+    try:
+        r = session.get(join_url(config['SERVER']['base_url'],
+                                 config['SERVER']['get_processing_requests'],
+                                 str(engine_id),
+                                 str(page_count)),
+                        params={'wait': wait,
+                                'loaded_engines': ','.join(str(engine_id) for engine_id in loaded_engine_ids)},
+                        headers=headers)
+    except requests.exceptions.ConnectionError:
+        return engine_id, None, None
 
-    start_time = time.time()
+    if r.status_code == 200:
+        request = r.json()
+        if request['status'] == 'success':
+            return request['engine_id'], [(page['page_id'], page['page_url']) for page in request['pages']], \
+                   request['lease_duration']
+    elif r.status_code == 204:
+        return engine_id, [], None
+    return engine_id, None, None
 
-    config = configparser.ConfigParser()
-    if args.config is not None:
-        config.read(args.config)
+
+def download_page(config, page_url):
+    req = Request(page_url)
+    req.add_header('User-Agent', 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like Gecko) Chrome/23.0.1271.64 Safari/537.11')
+    req.add_header('Accept', 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8')
+    if config['SERVER']['base_url'] in page_url:
+        req.add_header('api-key', config['SETTINGS']['api_key'])
+    return urlopen(req).read()
+
+
+def decode_page(page):
+    encoded_img = np.frombuffer(page, dtype=np.uint8)
+    image = cv2.imdecode(encoded_img, flags=cv2.IMREAD_ANYCOLOR)
+    if len(image.shape) == 2:
+        image = np.stack([image, image, image], axis=2)
+    return image
+
+
+def load_image(config, page_url, timing):
+    """
+    Downloads and decodes page image.
+    @return: image, fail type and traceback; image is None when loading failed
+    """
+    try:
+        with timing.stage('download'):
+            page = download_page(config, page_url)
+    except KeyboardInterrupt:
+        raise
+    except:
+        return None, 'NOT_FOUND', traceback.format_exc()
+
+    try:
+        with timing.stage('decode'):
+            image = decode_page(page)
+    except KeyboardInterrupt:
+        raise
+    except:
+        return None, 'INVALID_FILE', traceback.format_exc()
+
+    return image, None, None
+
+
+def export_page_layout(page_layout, engine_name, engine_version, min_confidence, arabic_helper, timing):
+    ocr_processing = create_ocr_processing_element(id="IdOcr",
+                                                   software_creator_str="Project PERO",
+                                                   software_name_str="{}" .format(engine_name),
+                                                   software_version_str="{}" .format(engine_version),
+                                                   processing_datetime=None)
+
+    with timing.stage('alto'):
+        alto_xml = page_layout.to_altoxml_string(ocr_processing=ocr_processing,
+                                                 min_line_confidence=min_confidence)
+
+    with timing.stage('arabic'):
+        if min_confidence > 0:
+            for region in page_layout.regions:
+                region.lines = \
+                    [l for l in region.lines if l.transcription_confidence and l.transcription_confidence > min_confidence]
+
+        for line in page_layout.lines_iterator():
+            if arabic_helper.is_arabic_line(line.transcription):
+                line.transcription = arabic_helper.label_form_to_string(line.transcription)
+
+    with timing.stage('page_xml'):
+        page_xml = page_layout.to_pagexml_string()
+        text = get_page_layout_text(page_layout)
+
+    return alto_xml, page_xml, text
+
+
+def failed_result(page_id, engine_version, fail_type, exception, timing):
+    return {'page_id': page_id,
+            'engine_version': engine_version,
+            'fail_type': fail_type,
+            'exception': exception,
+            'timings': timing.stages}
+
+
+def process_image(page_parser, image, page_id, engine_name, engine_version, min_confidence, arabic_helper, timing):
+    """
+    Runs OCR on decoded page image and serializes the results.
+    @return: result dictionary for send_result
+    """
+    try:
+        with timing.stage('process_page'):
+            page_layout = PageLayout(id=page_id, page_size=(image.shape[0], image.shape[1]))
+            page_layout = page_parser.process_page(image, page_layout)
+    except KeyboardInterrupt:
+        raise
+    except:
+        return failed_result(page_id, engine_version, 'PROCESSING_FAILED', traceback.format_exc(), timing)
+
+    alto_xml, page_xml, text = export_page_layout(page_layout, engine_name, engine_version, min_confidence,
+                                                  arabic_helper, timing)
+    return {'page_id': page_id,
+            'engine_version': engine_version,
+            'score': get_score(page_layout),
+            'alto_xml': alto_xml,
+            'page_xml': page_xml,
+            'text': text,
+            'timings': timing.stages}
+
+
+def send_result(session, config, args, result):
+    page_id = result['page_id']
+    if 'fail_type' in result:
+        headers = {'api-key': config['SETTINGS']['api_key'],
+                   'type': result['fail_type'],
+                   'engine-version': result['engine_version']}
+        if result['fail_type'] == 'PROCESSING_FAILED':
+            headers['hostname'] = socket.gethostname()
+            headers['ip-address'] = socket.gethostbyname(socket.gethostname())
+        session.post(
+            join_url(config['SERVER']['base_url'], config['SERVER']['post_failed_processing'], page_id),
+            data=result['exception'].encode('utf-8'),
+            headers=headers)
+    elif args.test_mode:
+        with open(os.path.join(args.test_path, '{}_alto.xml' .format(page_id)), "w") as file:
+            file.write(result['alto_xml'])
+        with open(os.path.join(args.test_path, '{}_page.xml' .format(page_id)), "w") as file:
+            file.write(result['page_xml'])
+        with open(os.path.join(args.test_path, '{}.txt' .format(page_id)), "w") as file:
+            file.write(result['text'])
     else:
-        config.read('config.ini')
+        headers = {'api-key': config['SETTINGS']['api_key'],
+                   'engine-version': result['engine_version'],
+                   'score': str(result['score'])}
+        if args.send_timings:
+            headers['timings'] = json.dumps(result['timings'])
+        session.post(join_url(config['SERVER']['base_url'], config['SERVER']['post_upload_results'], page_id),
+                     files={'alto': ('{}_alto.xml' .format(page_id), result['alto_xml'], 'text/plain'),
+                            'page': ('{}_page.xml' .format(page_id), result['page_xml'], 'text/plain'),
+                            'txt': ('{}.txt' .format(page_id), result['text'], 'text/plain')},
+                     headers=headers)
 
-    Path(config['SETTINGS']['engines_path']).mkdir(parents=True, exist_ok=True)
 
-    if args.api_key is not None:
-        config["SETTINGS"]['api_key'] = args.api_key
+def upload_result(session, config, args, result, timing_report):
+    """
+    Sends result to server and reports durations of processing stages of the page.
+    """
+    timing = PageTiming(result['timings'])
+    with timing.stage('upload'):
+        send_result(session, config, args, result)
+    timing_report.add(result, timing.stages)
 
-    if args.engine is not None:
-        config["SETTINGS"]['preferred_engine'] = args.preferred_engine
 
-    arabic_helper = ArabicHelper()
+def prefetch_pages(config, args, engine_id, engine_cache, lease_keeper, start_time, image_queue):
+    """
+    Pipeline stage leasing pages from server and downloading their images into image_queue.
+    """
+    headers = {'api-key': config['SETTINGS']['api_key']}
+    try:
+        with requests.Session() as session:
+            while not (args.time_limit > 0 and args.time_limit * 3600 < time.time() - start_time):
+                engine_id, pages, lease_duration = get_processing_pages(session, config, headers, engine_id,
+                                                                        args.lease_size, args.wait,
+                                                                        engine_cache.loaded_engine_ids())
+                if not pages:
+                    if args.exit_on_done:
+                        break
+                    if pages is None or args.wait <= 0:
+                        time.sleep(10)
+                    continue
+
+                lease_keeper.add([page_id for page_id, _ in pages], lease_duration)
+                for page_id, page_url in pages:
+                    timing = PageTiming()
+                    image, fail_type, exception = load_image(config, page_url, timing)
+                    image_queue.put((page_id, engine_id, image, fail_type, exception, timing))
+    finally:
+        image_queue.put(None)
+
+
+def upload_pages(config, args, lease_keeper, timing_report, result_queue):
+    """
+    Pipeline stage sending results from result_queue to server.
+    """
     with requests.Session() as session:
+        while True:
+            result = result_queue.get()
+            if result is None:
+                break
+            try:
+                upload_result(session, config, args, result, timing_report)
+            except requests.exceptions.RequestException:
+                traceback.print_exc()
+            lease_keeper.remove(result['page_id'])
+
+
+def run_pipeline(config, args, start_time, timing_report):
+    arabic_helper = ArabicHelper()
+    headers = {'api-key': config['SETTINGS']['api_key']}
+    engine_cache = EngineCache(config, headers, args.engine_cache_size)
+    engine_id = int(config['SETTINGS']['preferred_engine'])
+    page_parser, engine_name, engine_version = engine_cache.get(engine_id)
+
+    image_queue = queue.Queue(maxsize=args.prefetch)
+    result_queue = queue.Queue(maxsize=args.prefetch)
+    with LeaseKeeper(config) as lease_keeper:
+        prefetcher = threading.Thread(target=prefetch_pages,
+                                      args=(config, args, engine_id, engine_cache, lease_keeper, start_time,
+                                            image_queue),
+                                      daemon=True)
+        uploader = threading.Thread(target=upload_pages,
+                                    args=(config, args, lease_keeper, timing_report, result_queue),
+                                    daemon=True)
+        prefetcher.start()
+        uploader.start()
+
+        while True:
+            item = image_queue.get()
+            if item is None:
+                break
+
+            page_id, page_engine_id, image, fail_type, exception, timing = item
+            if page_engine_id != engine_id:
+                page_parser, engine_name, engine_version = engine_cache.get(page_engine_id)
+                engine_id = page_engine_id
+
+            if image is None:
+                result = failed_result(page_id, engine_version, fail_type, exception, timing)
+            else:
+                result = process_image(page_parser, image, page_id, engine_name, engine_version,
+                                       args.min_confidence, arabic_helper, timing)
+            result_queue.put(result)
+
+        result_queue.put(None)
+        uploader.join()
+
+
+def ocr_worker(config_dict, args, task_queue, result_queue):
+    """
+    OCR process of worker pool. Processes tasks from task_queue and puts results into result_queue.
+    """
+    config = configparser.ConfigParser()
+    config.read_dict(config_dict)
+    arabic_helper = ArabicHelper()
+    engine_cache = EngineCache(config, None, args.engine_cache_size)
+
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+
+            page_id, page_url, engine_id, engine_path, engine_name, engine_version = task
+            timing = PageTiming()
+            try:
+                page_parser = engine_cache.load(engine_id, engine_path)
+                image, fail_type, exception = load_image(config, page_url, timing)
+                if image is None:
+                    result = failed_result(page_id, engine_version, fail_type, exception, timing)
+                else:
+                    result = process_image(page_parser, image, page_id, engine_name, engine_version,
+                                           args.min_confidence, arabic_helper, timing)
+            except KeyboardInterrupt:
+                raise
+            except:
+                result = failed_result(page_id, engine_version, 'PROCESSING_FAILED', traceback.format_exc(),
+                                       timing)
+            result_queue.put(result)
+    except KeyboardInterrupt:
+        pass
+
+
+class OcrWorker(object):
+    """
+    OCR process of worker pool with its own task queue, so the pool knows which pages the process holds.
+    """
+
+    def __init__(self, config_dict, args, result_queue):
+        self.task_queue = multiprocessing.Queue()
+        self.tasks = OrderedDict()
+        self.process = multiprocessing.Process(target=ocr_worker,
+                                               args=(config_dict, args, self.task_queue, result_queue),
+                                               daemon=True)
+        self.process.start()
+
+    def put(self, task):
+        self.tasks[task[0]] = task
+        self.task_queue.put(task)
+
+
+class WorkerPool(object):
+    """
+    Pool of OCR processes. Process which died is replaced by a new one, the page it was processing is reported as
+    failed and its other pages are moved to the new process.
+    """
+
+    def __init__(self, config_dict, args, size):
+        self.config_dict = config_dict
+        self.args = args
+        self.result_queue = multiprocessing.Queue()
+        self.workers = [OcrWorker(config_dict, args, self.result_queue) for _ in range(size)]
+        self.page_workers = dict()
+
+    def __len__(self):
+        return len(self.page_workers)
+
+    def put(self, task, worker=None):
+        if worker is None:
+            worker = min(self.workers, key=lambda w: len(w.tasks))
+        worker.put(task)
+        self.page_workers[task[0]] = worker
+
+    def get(self, timeout):
+        """
+        Waits up to timeout seconds for result of some page and replaces dead processes.
+        @return: list of results, results of pages lost with dead processes are failed results
+        """
+        results = []
+        try:
+            results.append(self.result_queue.get(timeout=timeout))
+        except queue.Empty:
+            pass
+
+        dead_workers = [worker for worker in self.workers if not worker.process.is_alive()]
+        if dead_workers:
+            # results sent by dead processes before they exited are taken before their pages are failed
+            while True:
+                try:
+                    results.append(self.result_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+        # result of page already reported as failed because of dead process is dropped
+        results = [result for result in results if self.finish(result['page_id'])]
+        for worker in dead_workers:
+            results += self.restart(worker)
+        return results
+
+    def finish(self, page_id):
+        worker = self.page_workers.pop(page_id, None)
+        if worker is None:
+            return False
+        worker.tasks.pop(page_id)
+        return True
+
+    def restart(self, worker):
+        exitcode = worker.process.exitcode
+        print(f'OCR worker exited with code {exitcode}, starting new one.')
+        new_worker = OcrWorker(self.config_dict, self.args, self.result_queue)
+        self.workers[self.workers.index(worker)] = new_worker
+
+        tasks = list(worker.tasks.values())
+        for page_id, *_ in tasks:
+            del self.page_workers[page_id]
+        for task in tasks[1:]:
+            self.put(task, new_worker)
+
+        if not tasks:
+            return []
+        page_id, _, _, _, _, engine_version = tasks[0]
+        return [failed_result(page_id, engine_version, 'PROCESSING_FAILED',
+                              f'OCR worker process exited with code {exitcode} while processing the page.',
+                              PageTiming())]
+
+    def stop(self):
+        for worker in self.workers:
+            worker.task_queue.put(None)
+        for worker in self.workers:
+            worker.process.join()
+
+
+def run_workers(config, args, start_time, timing_report):
+    headers = {'api-key': config['SETTINGS']['api_key']}
+    engine_id = int(config['SETTINGS']['preferred_engine'])
+    dispatched_engine_id = None
+    # engines recently sent to workers, approximates engines the workers have loaded
+    dispatched_engine_ids = OrderedDict()
+
+    config_dict = {section: dict(config[section]) for section in config.sections()}
+    pool = WorkerPool(config_dict, args, args.workers)
+
+    with LeaseKeeper(config) as lease_keeper:
+        upload_queue = queue.Queue()
+        uploader = threading.Thread(target=upload_pages,
+                                    args=(config, args, lease_keeper, timing_report, upload_queue),
+                                    daemon=True)
+        uploader.start()
+
+        # keep every worker busy and one more page ready for each of them
+        max_pages_in_flight = 2 * args.workers
+        leasing = True
+        with requests.Session() as session:
+            while leasing or len(pool) > 0:
+                if args.time_limit > 0 and args.time_limit * 3600 < time.time() - start_time:
+                    leasing = False
+
+                if leasing and len(pool) < max_pages_in_flight:
+                    # do not hold the supervisor in long poll while workers return results
+                    wait = args.wait if len(pool) == 0 else 0
+                    engine_id, pages, lease_duration = get_processing_pages(session, config, headers, engine_id,
+                                                                            max_pages_in_flight - len(pool),
+                                                                            wait, list(dispatched_engine_ids))
+                    if pages:
+                        lease_keeper.add([page_id for page_id, _ in pages], lease_duration)
+                        if engine_id != dispatched_engine_id:
+                            engine_path, engine_name, engine_version = download_engine(config, headers, engine_id)
+                            dispatched_engine_id = engine_id
+                        dispatched_engine_ids[engine_id] = True
+                        dispatched_engine_ids.move_to_end(engine_id)
+                        while len(dispatched_engine_ids) > args.engine_cache_size:
+                            dispatched_engine_ids.popitem(last=False)
+                        for page_id, page_url in pages:
+                            pool.put((page_id, page_url, engine_id, engine_path, engine_name, engine_version))
+                        continue
+
+                    if args.exit_on_done and len(pool) == 0:
+                        break
+                    if len(pool) == 0:
+                        if pages is None or wait <= 0:
+                            time.sleep(10)
+                        continue
+
+                # timeout also bounds how long a dead worker stays unnoticed
+                for result in pool.get(timeout=10):
+                    upload_queue.put(result)
+
+        pool.stop()
+        upload_queue.put(None)
+        uploader.join()
+
+
+def run_sequential(config, args, start_time, timing_report):
+    arabic_helper = ArabicHelper()
+    with requests.Session() as session, LeaseKeeper(config) as lease_keeper:
         headers = {'api-key': config['SETTINGS']['api_key']}
-        page_parser, engine_name, engine_version = get_engine(config, headers, config["SETTINGS"]['preferred_engine'])
+        engine_cache = EngineCache(config, headers, args.engine_cache_size)
+        page_parser, engine_name, engine_version = engine_cache.get(config["SETTINGS"]['preferred_engine'])
 
         while True:
             if args.time_limit > 0 and args.time_limit * 3600 < time.time() - start_time:
@@ -117,6 +710,9 @@ def main():
                 r = session.get(join_url(config['SERVER']['base_url'],
                                          config['SERVER']['get_processing_request'],
                                          config['SETTINGS']['preferred_engine']),
+                                params={'wait': args.wait,
+                                        'loaded_engines': ','.join(str(engine_id)
+                                                                   for engine_id in engine_cache.loaded_engine_ids())},
                                 headers=headers)
             except requests.exceptions.ConnectionError:
                 status = 'failed'
@@ -124,6 +720,8 @@ def main():
                 if r.status_code == 200:
                     request = r.json()
                     status = request['status']
+                elif r.status_code == 204 and args.wait > 0:
+                    status = 'waited'
                 else:
                     status = 'failed'
 
@@ -131,117 +729,62 @@ def main():
                 page_id = request['page_id']
                 page_url = request['page_url']
                 engine_id = request['engine_id']
+                lease_keeper.add([page_id], request['lease_duration'])
                 if engine_id != int(config['SETTINGS']['preferred_engine']):
-                    page_parser, engine_name, engine_version = get_engine(config, headers, engine_id)
+                    page_parser, engine_name, engine_version = engine_cache.get(engine_id)
                     config['SETTINGS']['preferred_engine'] = str(engine_id)
 
-                # Download image from url.
-                try:
-                    req = Request(page_url)
-                    req.add_header('User-Agent', 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like Gecko) Chrome/23.0.1271.64 Safari/537.11')
-                    req.add_header('Accept', 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8')
-                    if config['SERVER']['base_url'] in page_url:
-                        req.add_header('api-key', config['SETTINGS']['api_key'])
-                    page = urlopen(req).read()
-                except KeyboardInterrupt:
-                    traceback.print_exc()
-                    print('Terminated by user.')
-                    sys.exit()
-                except:
-                    exception = traceback.format_exc()
-                    headers = {'api-key': config['SETTINGS']['api_key'],
-                               'type': 'NOT_FOUND',
-                               'engine-version': engine_version}
-                    session.post(
-                        join_url(config['SERVER']['base_url'], config['SERVER']['post_failed_processing'], page_id),
-                        data=exception.encode('utf-8'),
-                        headers=headers)
-                    continue
-
-                # Decode image
-                try:
-                    encoded_img = np.frombuffer(page, dtype=np.uint8)
-                    image = cv2.imdecode(encoded_img, flags=cv2.IMREAD_ANYCOLOR)
-                    if len(image.shape) == 2:
-                        image = np.stack([image, image, image], axis=2)
-                except KeyboardInterrupt:
-                    traceback.print_exc()
-                    print('Terminated by user.')
-                    sys.exit()
-                except:
-                    exception = traceback.format_exc()
-                    headers = {'api-key': config['SETTINGS']['api_key'],
-                               'type': 'INVALID_FILE',
-                               'engine-version': engine_version}
-                    session.post(
-                        join_url(config['SERVER']['base_url'], config['SERVER']['post_failed_processing'], page_id),
-                        data=exception,
-                        headers=headers)
-                    continue
-
-                # Process image
-                try:
-                    page_layout = PageLayout(id=page_id, page_size=(image.shape[0], image.shape[1]))
-                    page_layout = page_parser.process_page(image, page_layout)
-
-                except KeyboardInterrupt:
-                    traceback.print_exc()
-                    print('Terminated by user.')
-                    sys.exit()
-                except:
-                    exception = traceback.format_exc()
-                    headers = {'api-key': config['SETTINGS']['api_key'],
-                               'type': 'PROCESSING_FAILED',
-                               'engine-version': engine_version,
-                               'hostname': socket.gethostname(),
-                               'ip-address': socket.gethostbyname(socket.gethostname())}
-                    session.post(
-                        join_url(config['SERVER']['base_url'], config['SERVER']['post_failed_processing'], page_id),
-                        data=exception,
-                        headers=headers)
-                    continue
+                timing = PageTiming()
+                image, fail_type, exception = load_image(config, page_url, timing)
+                if image is None:
+                    result = failed_result(page_id, engine_version, fail_type, exception, timing)
                 else:
-                    ocr_processing = create_ocr_processing_element(id="IdOcr",
-                                                                   software_creator_str="Project PERO",
-                                                                   software_name_str="{}" .format(engine_name),
-                                                                   software_version_str="{}" .format(engine_version),
-                                                                   processing_datetime=None)
-
-                    alto_xml = page_layout.to_altoxml_string(ocr_processing=ocr_processing,
-                                                             min_line_confidence=args.min_confidence)
-
-                    if args.min_confidence > 0:
-                        for region in page_layout.regions:
-                            region.lines = \
-                                [l for l in region.lines if l.transcription_confidence and l.transcription_confidence > args.min_confidence]
-
-                    for line in page_layout.lines_iterator():
-                        if arabic_helper.is_arabic_line(line.transcription):
-                            line.transcription = arabic_helper.label_form_to_string(line.transcription)
-                    page_xml = page_layout.to_pagexml_string()
-                    text = get_page_layout_text(page_layout)
-
-                    if args.test_mode:
-                        with open(os.path.join(args.test_path, '{}_alto.xml' .format(page_id)), "w") as file:
-                            file.write(alto_xml)
-                        with open(os.path.join(args.test_path, '{}_page.xml' .format(page_id)), "w") as file:
-                            file.write(page_xml)
-                        with open(os.path.join(args.test_path, '{}.txt' .format(page_id)), "w") as file:
-                            file.write(text)
-                    else:
-                        headers = {'api-key': config['SETTINGS']['api_key'],
-                                   'engine-version': engine_version,
-                                   'score': str(get_score(page_layout))}
-                        session.post(join_url(config['SERVER']['base_url'], config['SERVER']['post_upload_results'], page_id),
-                                     files={'alto': ('{}_alto.xml' .format(page_id), alto_xml, 'text/plain'),
-                                            'page': ('{}_page.xml' .format(page_id), page_xml, 'text/plain'),
-                                            'txt': ('{}.txt' .format(page_id), text, 'text/plain')},
-                                     headers=headers)
+                    result = process_image(page_parser, image, page_id, engine_name, engine_version,
+                                           args.min_confidence, arabic_helper, timing)
+                upload_result(session, config, args, result, timing_report)
+                lease_keeper.remove(page_id)
 
             else:
                 if args.exit_on_done:
                     break
-                time.sleep(10)
+                if status != 'waited':
+                    time.sleep(10)
+
+
+def main():
+    args = get_args()
+
+    start_time = time.time()
+
+    config = configparser.ConfigParser()
+    if args.config is not None:
+        config.read(args.config)
+    else:
+        config.read('config.ini')
+
+    Path(config['SETTINGS']['engines_path']).mkdir(parents=True, exist_ok=True)
+
+    if args.api_key is not None:
+        config["SETTINGS"]['api_key'] = args.api_key
+
+    if args.engine is not None:
+        config["SETTINGS"]['preferred_engine'] = args.engine
+
+    timing_report = TimingReport(args.timing_log, args.timing_window, args.timing_interval)
+    try:
+        if args.workers > 0:
+            run_workers(config, args, start_time, timing_report)
+        elif args.pipeline:
+            run_pipeline(config, args, start_time, timing_report)
+        else:
+            run_sequential(config, args, start_time, timing_report)
+    except KeyboardInterrupt:
+        traceback.print_exc()
+        print('Terminated by user.')
+        sys.exit()
+    finally:
+        print(timing_report.summary())
+        timing_report.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,76 @@
+import json
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+
+STAGES = ['download', 'decode', 'process_page', 'alto', 'arabic', 'page_xml', 'upload']
+
+
+class PageTiming(object):
+    """
+    Durations of processing stages of one page in seconds.
+    """
+
+    def __init__(self, stages=None):
+        self.stages = OrderedDict() if stages is None else stages
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class TimingReport(object):
+    """
+    Writes timing record of every finished page into JSON lines log and periodically prints rolling summary of
+    throughput and p50/p95 of stages over the last window_size pages.
+    """
+
+    def __init__(self, log_path=None, window_size=100, interval=60):
+        self.log_file = open(log_path, 'a') if log_path is not None else None
+        self.window = deque(maxlen=window_size)
+        self.interval = interval
+        self.last_summary = time.time()
+
+    def add(self, result, stages):
+        now = time.time()
+        record = {'timestamp': now,
+                  'page_id': result['page_id'],
+                  'engine_version': result['engine_version'],
+                  'fail_type': result.get('fail_type'),
+                  'stages': stages}
+        self.window.append(record)
+        if self.log_file is not None:
+            self.log_file.write(json.dumps(record) + '\n')
+            self.log_file.flush()
+
+        if self.interval > 0 and now - self.last_summary >= self.interval:
+            self.last_summary = now
+            print(self.summary())
+
+    def summary(self):
+        if not self.window:
+            return 'TIMING: no pages processed.'
+
+        parts = [f'pages: {len(self.window)}']
+        duration = self.window[-1]['timestamp'] - self.window[0]['timestamp']
+        if duration > 0:
+            parts.append(f'pages/s: {(len(self.window) - 1) / duration:.2f}')
+        for stage in STAGES:
+            durations = [record['stages'][stage] for record in self.window if stage in record['stages']]
+            if durations:
+                parts.append(f'{stage} p50/p95: {percentile(durations, 0.5):.3f}/{percentile(durations, 0.95):.3f} s')
+        return 'TIMING: ' + ', '.join(parts)
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
@@ -10,6 +10,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from app.db.model import Engine, EngineVersion, Model, EngineVersionModel
+from app.engine_bundle import build_engine_bundle
 from config import Config
 
 
@@ -35,6 +36,9 @@ def get_args():
                         help="Voluntary for creating new engine_version, otherwise %Y-%m-%d is used as a name.")
     parser.add_argument("--engine_version_description", default=None,
                         help="Voluntary for creating new engine_version.")
+    parser.add_argument("--lease_duration", default=None, type=int,
+                        help="Voluntary seconds for which page of the engine stays leased to processing client "
+                             "without renewal, otherwise PAGE_LEASE_DURATION from config is used.")
     parser.add_argument("-d", "--database", required=True)
     parser.add_argument("-m", "--models", required=True, nargs='+',
                         help="List of models for new engine version. Model can be model ID (int) or path to folder "
@@ -59,7 +63,7 @@ if __name__ == '__main__':
     models = args.models
 
     # check validity of models
-    if len(models) < 2 and len(models) > 3:
+    if len(models) < 2 or len(models) > 3:
         print("Bad model count.")
         exit(-1)
 
@@ -80,11 +84,13 @@ if __name__ == '__main__':
 
     # get or create engine
     if engine is None:
-        db_engine = Engine(engine_name, engine_description)
+        db_engine = Engine(engine_name, engine_description, args.lease_duration)
         db_session.add(db_engine)
         db_session.commit()
     else:
         db_engine = db_session.query(Engine).filter(Engine.id == engine).first()
+        if args.lease_duration is not None:
+            db_engine.lease_duration = args.lease_duration
 
     # create new engine version
     if args.engine_version_name is None:
@@ -114,3 +120,7 @@ if __name__ == '__main__':
         db_session.add(engine_version_model)
 
     db_session.commit()
+
+    # prebuild bundle served to processing clients
+    Path(Config.ENGINE_BUNDLES_FOLDER).mkdir(parents=True, exist_ok=True)
+    build_engine_bundle(db_models, Config.MODELS_FOLDER, Config.ENGINE_BUNDLES_FOLDER, engine_version.id)
@@ -3,8 +3,9 @@ from app.db import Base
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 
-from app.db.api_key import generate_hash_key
+from app.db.api_key import generate_hash_key, invalidate_api_key_cache
 from app.db.model import ApiKey, Permission
+from config import Config
 
 
 def get_args():
@@ -16,15 +17,16 @@ def get_args():
     parser.add_argument("--owner", required=True)
     parser.add_argument("--database", required=True)
     parser.add_argument("--permission", default='USER', choices=['USER', 'SUPER_USER'])
+    parser.add_argument("--max-priority", type=int, default=0, help="The highest priority of requests of the user.")
 
     args = parser.parse_args()
 
     return args
 
 
-def add_new_api_key_to_db(db_session, owner, permission):
+def add_new_api_key_to_db(db_session, owner, permission, max_priority=0):
     api_string = generate_hash_key()
-    api_key = ApiKey(api_string, owner, permission)
+    api_key = ApiKey(api_string, owner, permission, max_priority)
     db_session.add(api_key)
     db_session.commit()
 
@@ -49,5 +51,6 @@ if __name__ == '__main__':
     Base.query = db_session.query_property()
     Base.metadata.create_all(bind=engine)
 
-    api_string = add_new_api_key_to_db(db_session, owner, permission)
+    api_string = add_new_api_key_to_db(db_session, owner, permission, args.max_priority)
+    invalidate_api_key_cache(Config.API_KEY_CACHE_INVALIDATION_FILE)
     print(api_string)
@@ -0,0 +1,132 @@
+import argparse
+from app.db import Base
+from sqlalchemy import create_engine, inspect, select, func, text
+
+from app.db.model import Request, Page, PageState, UNFINISHED_PAGE_STATES, PROCESSED_PAGE_STATES, FAILED_PAGE_STATES
+
+
+def get_args():
+    """
+    Brings database created by older version of the API up to date. Every migration checks whether it was already
+    applied, so the script can be run repeatedly.
+
+    CALL EXAMPLE:
+    python3 migrate_database.py -d sqlite:////mnt/c/database.db
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-d", "--database", required=True)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def add_request_counters(db_engine):
+    columns = [column['name'] for column in inspect(db_engine).get_columns('request')]
+    if 'page_count' in columns:
+        return
+
+    request_table = Request.__table__
+    page_table = Page.__table__
+
+    def count_pages(states=None):
+        query = select([func.count(page_table.c.id)]).where(page_table.c.request_id == request_table.c.id)
+        if states is not None:
+            query = query.where(page_table.c.state.in_(states))
+        return query.as_scalar()
+
+    with db_engine.begin() as connection:
+        for column in ['page_count', 'finished_page_count', 'processed_page_count', 'failed_page_count']:
+            connection.execute(text(f'ALTER TABLE request ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0'))
+        connection.execute(text('ALTER TABLE request ADD COLUMN score_sum FLOAT NOT NULL DEFAULT 0'))
+
+        finished_states = [state for state in PageState if state not in UNFINISHED_PAGE_STATES]
+        score_sum = select([func.coalesce(func.sum(page_table.c.score), 0)])\
+            .where(page_table.c.request_id == request_table.c.id)\
+            .where(page_table.c.state.in_(PROCESSED_PAGE_STATES))\
+            .as_scalar()
+        connection.execute(request_table.update().values(page_count=count_pages(),
+                                                         finished_page_count=count_pages(finished_states),
+                                                         processed_page_count=count_pages(PROCESSED_PAGE_STATES),
+                                                         failed_page_count=count_pages(FAILED_PAGE_STATES),
+                                                         score_sum=score_sum))
+    print('Added page counters to requests.')
+
+
+def add_request_priority(db_engine):
+    columns = [column['name'] for column in inspect(db_engine).get_columns('request')]
+    if 'priority' in columns:
+        return
+
+    with db_engine.begin() as connection:
+        connection.execute(text('ALTER TABLE request ADD COLUMN priority INTEGER NOT NULL DEFAULT 0'))
+    print('Added priority to requests.')
+
+
+def add_engine_lease_duration(db_engine):
+    columns = [column['name'] for column in inspect(db_engine).get_columns('engine')]
+    if 'lease_duration' in columns:
+        return
+
+    with db_engine.begin() as connection:
+        connection.execute(text('ALTER TABLE engine ADD COLUMN lease_duration INTEGER'))
+    print('Added lease duration to engines.')
+
+
+def add_page_waiting_timestamp(db_engine):
+    columns = [column['name'] for column in inspect(db_engine).get_columns('page')]
+    if 'waiting_timestamp' in columns:
+        return
+
+    # dispatch falls back to creation timestamp of request for pages without waiting timestamp
+    with db_engine.begin() as connection:
+        connection.execute(text('ALTER TABLE page ADD COLUMN waiting_timestamp TIMESTAMP'))
+    print('Added waiting timestamp to pages.')
+
+
+def add_api_key_max_priority(db_engine):
+    columns = [column['name'] for column in inspect(db_engine).get_columns('api_key')]
+    if 'max_priority' in columns:
+        return
+
+    with db_engine.begin() as connection:
+        connection.execute(text('ALTER TABLE api_key ADD COLUMN max_priority INTEGER NOT NULL DEFAULT 0'))
+    print('Added maximal priority to API keys.')
+
+
+def add_notification_subject(db_engine):
+    columns = [column['name'] for column in inspect(db_engine).get_columns('notification')]
+    if 'subject' in columns:
+        return
+
+    with db_engine.begin() as connection:
+        connection.execute(text('ALTER TABLE notification ADD COLUMN subject VARCHAR'))
+    print('Added subject to notifications.')
+
+
+def create_missing_indexes(db_engine):
+    # unique index of page names fails on databases containing duplicate page names in one request,
+    # such pages have to be renamed or removed first
+    for table in Base.metadata.sorted_tables:
+        existing_indexes = [index['name'] for index in inspect(db_engine).get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=db_engine)
+                print(f'Created index {index.name}.')
+
+
+MIGRATIONS = [add_request_counters, add_request_priority, add_engine_lease_duration, add_page_waiting_timestamp,
+              add_api_key_max_priority, add_notification_subject, create_missing_indexes]
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    db_engine = create_engine(f'{args.database}',
+                              convert_unicode=True,
+                              connect_args={})
+    Base.metadata.create_all(bind=db_engine)
+
+    for migration in MIGRATIONS:
+        migration(db_engine)
@@ -0,0 +1,48 @@
+import argparse
+from app.db import Base
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from app.db.api_key import invalidate_api_key_cache
+from app.db.model import ApiKey
+from config import Config
+
+
+def get_args():
+    """
+    method for parsing of arguments
+    """
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--database", required=True)
+    parser.add_argument("--api-keys", nargs='+', required=True, help="List of API keys to change.")
+    parser.add_argument("--max-priority", type=int, required=True,
+                        help="The highest priority of requests of the API keys, "
+                             "higher priorities are clamped also to MAX_REQUEST_PRIORITY.")
+
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    engine = create_engine(f'{args.database}',
+                           convert_unicode=True,
+                           connect_args={})
+    db_session = scoped_session(sessionmaker(autocommit=False,
+                                             autoflush=False,
+                                             bind=engine))
+    Base.query = db_session.query_property()
+    Base.metadata.create_all(bind=engine)
+
+    api_keys = db_session.query(ApiKey).filter(ApiKey.api_string.in_(args.api_keys)).all()
+    for api_key in api_keys:
+        api_key.max_priority = args.max_priority
+    db_session.commit()
+    invalidate_api_key_cache(Config.API_KEY_CACHE_INVALIDATION_FILE)
+
+    missing_api_keys = set(args.api_keys) - {api_key.api_string for api_key in api_keys}
+    for api_string in missing_api_keys:
+        print(f'API key {api_string} does not exist.')
@@ -3,7 +3,9 @@ from app.db import Base
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 
+from app.db.api_key import invalidate_api_key_cache
 from app.db.model import ApiKey
+from config import Config
 
 
 def get_args():
@@ -44,3 +46,4 @@ if __name__ == '__main__':
             else:
                 api_key.suspension = True
     db_session.commit()
+    invalidate_api_key_cache(Config.API_KEY_CACHE_INVALIDATION_FILE)
@@ -0,0 +1,73 @@
+import os
+import sys
+import uuid
+import tempfile
+
+import pytest
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE_FOLDER = 'C:/Users/LachubCz_NTB/Documents/GitHub/PERO-API'
+
+# app reads database_url and Config from module config when it is imported, tests use config-example.py with all
+# folders and the SQLite database in a temporary directory and without e-mail recipients
+test_folder = tempfile.mkdtemp(prefix='pero_api_tests_')
+with open(os.path.join(REPOSITORY_ROOT, 'config-example.py')) as f:
+    config_source = f.read()
+config_source = config_source.replace(f"'sqlite:///{EXAMPLE_FOLDER}/app/database.db'",
+                                      f"'sqlite:///{test_folder}/database.db'")
+config_source = config_source.replace(EXAMPLE_FOLDER, test_folder)
+config_source = config_source.replace('EMAIL_NOTIFICATION_ADDRESSES = ["example1@google.com", "example2@google.com"]',
+                                      'EMAIL_NOTIFICATION_ADDRESSES = []')
+with open(os.path.join(test_folder, 'config.py'), 'w') as f:
+    f.write(config_source)
+sys.path.insert(0, test_folder)
+sys.path.insert(0, REPOSITORY_ROOT)
+
+from app import create_app
+from app.db.model import ApiKey, Engine, Permission
+
+
+@pytest.fixture(scope='session')
+def app():
+    return create_app()
+
+
+@pytest.fixture
+def db_session(app):
+    from flask_sqlalchemy_session import current_session
+    with app.test_request_context():
+        yield current_session
+
+
+@pytest.fixture
+def api_key(db_session):
+    api_key = ApiKey(f'test_{uuid.uuid4()}', 'test', Permission.SUPER_USER)
+    db_session.add(api_key)
+    db_session.commit()
+    return api_key
+
+
+@pytest.fixture
+def engine(db_session):
+    engine = Engine(f'test_{uuid.uuid4()}', 'test engine')
+    db_session.add(engine)
+    db_session.commit()
+    return engine
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def create_request(client, api_key, engine):
+    """
+    @return: function creating request with pages of given names and urls, returns request ID
+    """
+    def create(images):
+        response = client.post('/post_processing_request', json={'engine': engine.id, 'images': images},
+                               headers={'api-key': api_key.api_string})
+        assert response.status_code == 200
+        return response.get_json()['request_id']
+    return create
@@ -0,0 +1,66 @@
+import datetime
+
+from app import reset_expired_pages
+from app.db.model import Page, PageState
+from app.main.general import lease_pages, claim_pages, invalidate_dispatch_statistics
+
+
+def get_pages(db_session, request_id):
+    db_session.expire_all()
+    return {page.name: page for page in db_session.query(Page).filter(Page.request_id == request_id)}
+
+
+def test_lease_pages_leases_every_page_once(db_session, engine, create_request):
+    request_id = create_request({f'page_{i}': f'http://example.com/{i}.jpg' for i in range(10)})
+    invalidate_dispatch_statistics()
+
+    # dispatch statistics are cached, later leases work with a stale snapshot of waiting pages
+    leased = []
+    for _ in range(4):
+        leased += [page.id for page in lease_pages(engine.id, 3)]
+
+    assert len(leased) == len(set(leased)) == 10
+    assert all(page.state == PageState.PROCESSING for page in get_pages(db_session, request_id).values())
+
+
+def test_claim_pages_skips_pages_which_are_not_waiting(db_session, create_request):
+    request_id = create_request({'waiting': 'http://example.com/1.jpg',
+                                 'processing': 'http://example.com/2.jpg',
+                                 'created': None})
+    pages = get_pages(db_session, request_id)
+    pages['processing'].state = PageState.PROCESSING
+    db_session.commit()
+
+    # candidates selected before another client leased the page still contain it
+    candidates = db_session.query(Page.id).filter(Page.request_id == request_id)
+    claimed = claim_pages(candidates, datetime.datetime.now())
+    db_session.commit()
+
+    assert [page.id for page in claimed] == [pages['waiting'].id]
+    pages = get_pages(db_session, request_id)
+    assert pages['created'].state == PageState.CREATED
+
+
+def test_reset_expired_pages_keeps_renewed_leases(db_session, create_request):
+    request_id = create_request({'expired': 'http://example.com/1.jpg', 'renewed': 'http://example.com/2.jpg'})
+    now = datetime.datetime.now()
+    pages = get_pages(db_session, request_id)
+    for page in pages.values():
+        page.state = PageState.PROCESSING
+        page.processing_timestamp = now - datetime.timedelta(hours=1)
+    db_session.commit()
+    page_ids = [page.id for page in pages.values()]
+
+    # lease is renewed after the reaper selected expired pages
+    pages['renewed'].processing_timestamp = now
+    db_session.commit()
+
+    reset_page_ids = reset_expired_pages(db_session, page_ids, now - datetime.timedelta(minutes=1))
+    db_session.commit()
+
+    assert reset_page_ids == {pages['expired'].id}
+    pages = get_pages(db_session, request_id)
+    assert pages['expired'].state == PageState.WAITING
+    assert pages['expired'].processing_timestamp is None
+    assert pages['expired'].waiting_timestamp is not None
+    assert pages['renewed'].state == PageState.PROCESSING
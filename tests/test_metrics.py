@@ -0,0 +1,34 @@
+from flask import Flask
+
+from app import engine
+from app.metrics import init_metrics, http_requests
+
+
+def get_request_count(route, status):
+    return http_requests.labels(method='GET', route=route, status=status)._value.get()
+
+
+def test_failed_request_is_recorded():
+    app = Flask(__name__)
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    init_metrics(app, engine)
+
+    @app.route('/test_failing_route')
+    def failing_route():
+        raise RuntimeError('test')
+
+    count = get_request_count('/test_failing_route', '500')
+    assert app.test_client().get('/test_failing_route').status_code == 500
+    assert get_request_count('/test_failing_route', '500') == count + 1
+
+
+def test_metrics_require_token_or_allowed_address(app, client):
+    app.config['METRICS_TOKEN'] = 'test_token'
+    remote = {'REMOTE_ADDR': '192.0.2.1'}
+
+    assert client.get('/metrics', environ_base=remote).status_code == 401
+    assert client.get('/metrics', environ_base=remote, headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', environ_base=remote, headers={'Authorization': 'Bearer test_token'})
+    assert response.status_code == 200
+    assert b'pero_http_requests_total' in response.data
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 200
@@ -0,0 +1,68 @@
+import uuid
+
+from sqlalchemy import create_engine, inspect, text
+
+from app.db import Base
+from scripts.migrate_database import MIGRATIONS
+
+# tables of the first released version of the API changed by migrations
+OLD_SCHEMA = [
+    'CREATE TABLE api_key (id INTEGER PRIMARY KEY, api_string VARCHAR NOT NULL, owner VARCHAR NOT NULL, '
+    'permission VARCHAR(10) NOT NULL, suspension BOOLEAN NOT NULL)',
+    'CREATE TABLE engine (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, description VARCHAR)',
+    'CREATE TABLE request (id VARCHAR PRIMARY KEY, creation_timestamp DATETIME NOT NULL, '
+    'modification_timestamp DATETIME NOT NULL, finish_timestamp DATETIME, engine_id INTEGER NOT NULL, '
+    'api_key_id INTEGER NOT NULL)',
+    'CREATE TABLE page (id VARCHAR PRIMARY KEY, name VARCHAR NOT NULL, url VARCHAR, state VARCHAR(17) NOT NULL, '
+    'score FLOAT, traceback VARCHAR, processing_timestamp DATETIME, finish_timestamp DATETIME, '
+    'request_id VARCHAR NOT NULL, engine_version INTEGER)',
+    'CREATE TABLE notification (id INTEGER PRIMARY KEY, last_notification DATETIME NOT NULL)',
+]
+
+
+def migrate(db_engine):
+    Base.metadata.create_all(bind=db_engine)
+    for migration in MIGRATIONS:
+        migration(db_engine)
+
+
+def get_columns(db_engine, table):
+    return {column['name'] for column in inspect(db_engine).get_columns(table)}
+
+
+def test_migrations_update_old_database_repeatedly(tmp_path):
+    db_engine = create_engine(f'sqlite:///{tmp_path}/old.db')
+    request_id = '%.32x' % uuid.uuid4().int
+    with db_engine.begin() as connection:
+        for statement in OLD_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text("INSERT INTO api_key VALUES (1, 'key', 'owner', 'USER', 0)"))
+        connection.execute(text("INSERT INTO engine VALUES (1, 'engine', NULL)"))
+        connection.execute(text("INSERT INTO request VALUES (:id, '2020-01-01 00:00:00', '2020-01-01 00:00:00', "
+                                "NULL, 1, 1)"), id=request_id)
+        for i, (state, score) in enumerate([('PROCESSED', 80.0), ('PROCESSED', 90.0), ('NOT_FOUND', None),
+                                            ('WAITING', None)]):
+            connection.execute(text("INSERT INTO page (id, name, state, score, request_id) "
+                                    "VALUES (:id, :name, :state, :score, :request_id)"),
+                               id='%.32x' % uuid.uuid4().int, name=f'page_{i}', state=state, score=score,
+                               request_id=request_id)
+
+    migrate(db_engine)
+    migrate(db_engine)
+
+    assert {'page_count', 'finished_page_count', 'processed_page_count', 'failed_page_count', 'score_sum',
+            'priority'} <= get_columns(db_engine, 'request')
+    assert 'waiting_timestamp' in get_columns(db_engine, 'page')
+    assert 'lease_duration' in get_columns(db_engine, 'engine')
+    assert 'max_priority' in get_columns(db_engine, 'api_key')
+    assert 'subject' in get_columns(db_engine, 'notification')
+    for table in Base.metadata.sorted_tables:
+        existing_indexes = {index['name'] for index in inspect(db_engine).get_indexes(table.name)}
+        assert {index.name for index in table.indexes} <= existing_indexes
+
+    with db_engine.connect() as connection:
+        counters = connection.execute(text('SELECT page_count, finished_page_count, processed_page_count, '
+                                           'failed_page_count, score_sum, priority FROM request')).fetchall()
+        max_priority = connection.execute(text('SELECT max_priority FROM api_key')).scalar()
+    assert counters == [(4, 3, 2, 1, 170.0, 0)]
+    assert max_priority == 0
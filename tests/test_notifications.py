@@ -0,0 +1,38 @@
+import datetime
+
+from app import session_factory
+from app.db.model import Notification
+from app.mail.notifications import NotificationQueue
+
+
+def create_queue(frequency=3600, digest_size=2):
+    queue = NotificationQueue()
+    queue.config = {'EMAIL_NOTIFICATION_ADDRESSES': ['admin@example.com'], 'MAX_EMAIL_FREQUENCY': frequency,
+                    'MAX_NOTIFICATION_DIGEST_SIZE': digest_size, 'NOTIFICATION_CHECK_INTERVAL': 60,
+                    'MAIL_SERVER': '', 'MAIL_USERNAME': '', 'MAIL_PASSWORD': ''}
+    queue.session_factory = session_factory
+    return queue
+
+
+def test_rate_limit_and_queue_are_shared_by_processes(app):
+    subject = f'test {datetime.datetime.now()}'
+    first_process, second_process = create_queue(), create_queue()
+    for i in range(3):
+        first_process.notify(subject, f'body {i}')
+
+    digests, _ = second_process.next_digests()
+    assert [digest for digest in digests if digest[0] == subject] == [(subject, ['body 0', 'body 1'], 1)]
+
+    first_process.notify(subject, 'body 3')
+    digests, timeout = first_process.next_digests()
+    assert [digest for digest in digests if digest[0] == subject] == []
+    assert timeout > 0
+
+    # the notification stays queued until MAX_EMAIL_FREQUENCY passes
+    db_session = session_factory()
+    db_session.query(Notification).filter(Notification.subject == subject)\
+              .update({Notification.last_notification: datetime.datetime.now() - datetime.timedelta(hours=2)})
+    db_session.commit()
+    db_session.close()
+    digests, _ = second_process.next_digests()
+    assert [digest for digest in digests if digest[0] == subject] == [(subject, ['body 3'], 0)]
@@ -0,0 +1,88 @@
+import io
+import tarfile
+
+import pytest
+
+from app.db.model import Page, PageState
+
+
+@pytest.fixture
+def limits(app):
+    """
+    Small upload limits, restored after test.
+    """
+    original = {key: app.config[key] for key in ['MAX_IMAGE_ARCHIVE_SIZE', 'MAX_UPLOAD_CHUNK_SIZE']}
+    app.config['MAX_IMAGE_ARCHIVE_SIZE'] = 20000
+    app.config['MAX_UPLOAD_CHUNK_SIZE'] = 1000
+    yield app.config
+    app.config.update(original)
+
+
+def create_tar(names, size):
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        for name in names:
+            data = bytes(range(256)) * (size // 256)
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+    return archive.getvalue()
+
+
+def get_page_states(db_session, request_id):
+    db_session.expire_all()
+    pages = db_session.query(Page.name, Page.state).filter(Page.request_id == request_id).all()
+    return {name: state for name, state in pages}
+
+
+def test_archive_larger_than_limit_is_rejected_by_content_length(client, api_key, create_request, limits):
+    request_id = create_request({'page_0': None, 'page_1': None, 'page_2': None})
+    archive = create_tar(['page_0.jpg', 'page_1.jpg', 'page_2.jpg'], 9000)
+
+    response = client.post(f'/upload_images/{request_id}', data=archive, headers={'api-key': api_key.api_string})
+
+    assert response.status_code == 413
+
+
+def test_streamed_archive_is_cut_at_limit(client, db_session, api_key, create_request, limits):
+    request_id = create_request({'page_0': None, 'page_1': None, 'page_2': None})
+    archive = create_tar(['page_0.jpg', 'page_1.jpg', 'page_2.jpg'], 9000)
+
+    # chunked transfer has no content length, size is checked while the archive is read
+    response = client.post(f'/upload_images/{request_id}', input_stream=io.BytesIO(archive),
+                           headers={'api-key': api_key.api_string, 'Transfer-Encoding': 'chunked'},
+                           environ_base={'wsgi.input_terminated': True})
+
+    assert response.status_code == 413
+    # images read before the limit was reached are kept
+    states = get_page_states(db_session, request_id)
+    assert states['page_0'] == PageState.WAITING
+    assert states['page_2'] == PageState.CREATED
+    assert response.get_json()['uploaded_page_count'] == list(states.values()).count(PageState.WAITING)
+
+
+def test_truncated_archive_keeps_extracted_pages(client, db_session, api_key, create_request, limits):
+    request_id = create_request({'page_0': None, 'page_1': None})
+    archive = create_tar(['page_0.jpg', 'page_1.jpg'], 4000)
+
+    response = client.post(f'/upload_images/{request_id}', data=archive[:6000],
+                           headers={'api-key': api_key.api_string})
+
+    assert response.status_code == 400
+    assert response.get_json()['uploaded_page_count'] == 1
+    assert get_page_states(db_session, request_id) == {'page_0': PageState.WAITING, 'page_1': PageState.CREATED}
+
+
+def test_chunk_larger_than_limit_is_rejected(client, api_key, create_request, limits):
+    request_id = create_request({'page_0': None})
+    headers = {'api-key': api_key.api_string}
+    assert client.post(f'/upload_image_chunked/{request_id}/page_0.jpg', headers=headers).status_code == 200
+
+    response = client.put(f'/upload_image_chunked/{request_id}/page_0.jpg', data=b'x' * 1001,
+                          headers={**headers, 'upload-offset': '0'})
+    assert response.status_code == 413
+
+    response = client.put(f'/upload_image_chunked/{request_id}/page_0.jpg', data=b'x' * 1000,
+                          headers={**headers, 'upload-offset': '0'})
+    assert response.status_code == 200
+    assert response.get_json()['offset'] == 1000
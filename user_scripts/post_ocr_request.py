@@ -4,8 +4,17 @@
 # Second enter the resulting format (alto, txt, page)
 
 import os
+import re
+import time
+import json
+import random
 import requests
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+UPLOADED_PAGE_STATES = {'WAITING', 'PROCESSING', 'PROCESSED'}
 
 
 def parse_arguments():
@@ -15,6 +24,11 @@ def parse_arguments():
     parser.add_argument('-e', '--engine-id', type=int, help='OCR engine ID', required=True)
     parser.add_argument('-l', '--url-list', type=str, help='File with name, url  -- URL can be empty - in that case uploads file "name" from upload directory to server.', required=True)
     parser.add_argument('-d', '--image-path', type=str, help='Directory with files to be uploaded.')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Number of parallel uploads.')
+    parser.add_argument('-r', '--retries', type=int, default=5, help='Number of retries of failed upload.')
+    parser.add_argument('-s', '--state-file', type=str,
+                        help='File recording request ID and uploaded images, rerun with the same file uploads only '
+                             'missing images of the same request. Default is url list file with .state suffix.')
     args = parser.parse_args()
     return args
 
@@ -87,39 +101,116 @@ def post_request(server_url, api_key, request_dict):
     return response['request_id']
 
 
-def upload_images(server_url, api_key, request_dict, request_id, image_path):
-    session = requests.Session()
-    headers = {"api-key": api_key}
-    for image_name in request_dict['images']:
-        file_path = os.path.join(image_path, image_name)
-        if not os.path.exists(file_path):
-            print(f'ERROR: Missing file {file_path}')
+class UploadState(object):
+    """
+    Progress of upload stored in JSON lines file. First line contains request ID, every next line one uploaded image,
+    so the file is only appended to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.request_id = None
+        self.uploaded = set()
+        self.lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if 'request_id' in record:
+                        self.request_id = record['request_id']
+                    else:
+                        self.uploaded.add(record['image'])
+
+    def set_request_id(self, request_id):
+        self.request_id = request_id
+        self.uploaded = set()
+        with open(self.path, 'w') as f:
+            f.write(json.dumps({'request_id': request_id}) + '\n')
+
+    def add_uploaded(self, image_name):
+        with self.lock:
+            self.uploaded.add(image_name)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'image': image_name}) + '\n')
+
+
+def upload_image(session, server_url, api_key, request_id, image_path, image_name, retries):
+    """
+    Uploads one image, connection errors and server errors are retried with exponential backoff.
+    @return: None on success, otherwise error message
+    """
+    file_path = os.path.join(image_path, image_name)
+    if not os.path.exists(file_path):
+        return f'Missing file {file_path}'
+
+    url = f'{server_url}/upload_image/{request_id}/{image_name}'
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(min(2 ** (attempt - 1), 60) * random.uniform(0.5, 1.5))
+        try:
+            with open(file_path, 'rb') as f:
+                r = session.post(url, files={'file': f}, headers={"api-key": api_key})
+        except requests.exceptions.RequestException as e:
+            error = f'Connection failed: {e}'
             continue
 
-        url = f'{server_url}/upload_image/{request_id}/{image_name}'
-        print(url)
-        with open(file_path, 'rb') as f:
-            r = session.post(url, files={'file': f}, headers=headers)
-        print(r.text)
-        if r.status_code == 202:
-            print(f'ERROR: Page in wrong state.')
-            continue
+        if r.status_code == 200:
+            return None
         if r.status_code == 400:
-            print(f'ERROR: Request with id {request_id} does not exist.')
-            continue
+            # uploaded by previous run which ended before recording it, other states mean the page is finished
+            # without its image (canceled, expired or failed)
+            page_state = re.search(r'is in (\w+) state', r.text)
+            if page_state is not None and page_state.group(1) in UPLOADED_PAGE_STATES:
+                return None
         if r.status_code == 401:
-            print(f'ERROR: Request with id {request_id} does not belong to this API key.')
-            continue
+            return f'Request with id {request_id} does not belong to this API key.'
         if r.status_code == 404:
-            print(f'ERROR: Page with name {image_name} does not exist in request {request_id}.')
-            continue
+            return f'Page with name {image_name} does not exist in request {request_id}.'
         if r.status_code == 422:
-            print(f'ERROR: Unsupported image file extension {image_name}.')
-            continue
-        if r.status_code != 200:
-            print(f'ERROR: Request returned with unexpected status code: {r.status_code}')
-            print(r.text)
-            continue
+            return f'Unsupported image file extension {image_name}.'
+        error = f'Request returned with unexpected status code: {r.status_code} {r.text}'
+        if r.status_code < 500 and r.status_code != 429:
+            return error
+
+    return error
+
+
+def upload_images(server_url, api_key, request_dict, request_id, image_path, threads, retries, state):
+    image_names = [image_name for image_name in request_dict['images'] if image_name not in state.uploaded]
+    print(f'Uploading {len(image_names)} images, {len(state.uploaded)} images were uploaded before.')
+
+    thread_local = threading.local()
+
+    def upload(image_name):
+        if not hasattr(thread_local, 'session'):
+            thread_local.session = requests.Session()
+        error = upload_image(thread_local.session, server_url, api_key, request_id, image_path, image_name, retries)
+        if error is None:
+            state.add_uploaded(image_name)
+        else:
+            print(f'ERROR: {image_name}: {error}')
+        return image_name, error
+
+    start_time = time.time()
+    uploaded_bytes = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for i, (image_name, error) in enumerate(executor.map(upload, image_names)):
+            if error is None:
+                uploaded_bytes += os.path.getsize(os.path.join(image_path, image_name))
+            else:
+                failed.append(image_name)
+            if (i + 1) % 100 == 0:
+                print(f'{i + 1}/{len(image_names)} images processed.')
+
+    duration = max(time.time() - start_time, 1e-6)
+    uploaded_count = len(image_names) - len(failed)
+    print(f'Uploaded {uploaded_count} images, {uploaded_bytes / 1024 ** 2:.1f} MB in {duration:.1f} s '
+          f'({uploaded_count / duration:.2f} images/s, {uploaded_bytes / 1024 ** 2 / duration:.2f} MB/s).')
+    if failed:
+        print(f'ERROR: {len(failed)} images failed to upload, run the script again to upload them.')
+
+    return failed
 
 
 def main():
@@ -147,12 +238,24 @@ def main():
     else:
         request_dict = create_request_dict(engines[args.engine_id]['id'], args.url_list)
 
-    request_id = post_request(args.api_url, args.api_key, request_dict)
-    print('OCR request successfully submitted with id:', request_id)
+    if not args.image_path:
+        request_id = post_request(args.api_url, args.api_key, request_dict)
+        print('OCR request successfully submitted with id:', request_id)
+        return
 
-    if args.image_path:
-        upload_images(args.api_url, args.api_key, request_dict, request_id, args.image_path)
+    state = UploadState(args.state_file if args.state_file else args.url_list + '.state')
+    if state.request_id is not None:
+        request_id = state.request_id
+        print(f'Resuming upload of images of OCR request with id {request_id} recorded in {state.path}.')
+    else:
+        request_id = post_request(args.api_url, args.api_key, request_dict)
+        state.set_request_id(request_id)
+        print('OCR request successfully submitted with id:', request_id)
 
+    failed = upload_images(args.api_url, args.api_key, request_dict, request_id, args.image_path, args.threads,
+                           args.retries, state)
+    if failed:
+        exit(-1)
 
 
 if __name__ == "__main__":
@@ -5,9 +5,22 @@
 
 import os
 import sys
+import time
+import shutil
+import tarfile
+import datetime
+import tempfile
 import requests
 import argparse
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# file name suffixes of results in archives returned by download_request_results
+ARCHIVE_SUFFIXES = {'_alto.xml': 'alto', '_page.xml': 'page', '.txt': 'txt'}
+# pages finished shortly before previous download may be committed after it, they are downloaded again
+WATCH_OVERLAP = datetime.timedelta(seconds=60)
 
 
 def parse_arguments():
@@ -19,13 +32,17 @@ def parse_arguments():
     parser.add_argument('--alto', action='store_true', help='Download results in ALTO XML format.')
     parser.add_argument('--page', action='store_true', help='Download results in PAGE XML format.')
     parser.add_argument('--txt', action='store_true', help='Download results in plain text format.')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Number of parallel downloads.')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Repeatedly download results of newly processed pages until the request is finished.')
+    parser.add_argument('--watch-interval', type=float, default=30, help='Seconds between downloads in watch mode.')
     args = parser.parse_args()
     return args
 
 
-def get_request_status(server_url, api_key, request_id):
+def get_request_status(server_url, api_key, request_id, summary_only=False):
     url = f"{server_url}/request_status/{request_id}"
-    r = requests.get(url, headers={"api-key": api_key})
+    r = requests.get(url, params={'summary_only': 'true' if summary_only else 'false'}, headers={"api-key": api_key})
 
     if r.status_code == 401:
         print(f'ERROR: Request with id {request_id} does not belong to this API key.')
@@ -45,9 +62,28 @@ def get_request_status(server_url, api_key, request_id):
         print(response)
         exit(-1)
 
+    if summary_only:
+        return response['request_summary']
     return response['request_status']
 
 
+def write_file(file_path, source):
+    """
+    Writes bytes or content of file object under temporary name and renames it, so partial files never appear.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if isinstance(source, bytes):
+                f.write(source)
+            else:
+                shutil.copyfileobj(source, f)
+        os.replace(tmp_path, file_path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
 def download_results(page_name, session, server_url, api_key, request_id, output_path, alto, page, txt):
     path = os.path.join(output_path, page_name)
     requested_formats = []
@@ -79,27 +115,97 @@ def download_results(page_name, session, server_url, api_key, request_id, output
             print(r.text)
             continue
 
-        with open(file_path, 'w') as f:
-            f.write(r.text)
+        write_file(file_path, r.content)
+
+
+def download_new_results(session, server_url, api_key, request_id, output_path, formats, since):
+    """
+    Downloads results of pages processed after since as one tar stream and extracts them.
+    @return: timestamp of the download to be used as since of the next one, number of extracted files
+    """
+    params = {'formats': ','.join(formats), 'archive': 'tar'}
+    if since is not None:
+        params['since'] = since.isoformat()
+    url = f"{server_url}/download_request_results/{request_id}"
+    extracted = 0
+    with session.get(url, params=params, headers={"api-key": api_key}, stream=True) as r:
+        if r.status_code != 200:
+            print(f'ERROR: Request returned with unexpected status code: {r.status_code}')
+            print(r.text)
+            return since, extracted
+
+        results_timestamp = datetime.datetime.fromisoformat(r.headers['results-timestamp'])
+        with tarfile.open(fileobj=r.raw, mode='r|') as archive:
+            for member in archive:
+                for suffix, file_format in ARCHIVE_SUFFIXES.items():
+                    if member.isfile() and member.name.endswith(suffix):
+                        page_name = os.path.basename(member.name[:-len(suffix)])
+                        write_file(os.path.join(output_path, f'{page_name}.{file_format}'),
+                                   archive.extractfile(member))
+                        extracted += 1
+                        break
+
+    return results_timestamp - WATCH_OVERLAP, extracted
+
+
+def watch_results(args, formats):
+    session = requests.Session()
+    since = None
+    while True:
+        # summary is taken before download, so the last download contains all pages of finished request
+        summary = get_request_status(args.api_url, args.api_key, args.request_id, summary_only=True)
+        since, extracted = download_new_results(session, args.api_url, args.api_key, args.request_id,
+                                                args.output_path, formats, since)
+        print(f'{extracted} result files downloaded, {summary["finished_page_count"]}/{summary["page_count"]} '
+              f'pages finished.')
+        if summary['finished_page_count'] >= summary['page_count']:
+            break
+        time.sleep(args.watch_interval)
+
+    print('SUMMARY:')
+    print('PROCESSED', summary['processed_page_count'])
+    print('FAILED', summary['failed_page_count'])
+    print('ALL PAGES DONE')
 
 
 def main():
     args = parse_arguments()
+    os.makedirs(args.output_path, exist_ok=True)
+
+    if args.watch:
+        formats = [file_format for file_format, requested in [('alto', args.alto), ('page', args.page),
+                                                              ('txt', args.txt)] if requested]
+        if not formats:
+            print('ERROR: No result format requested, use --alto, --page or --txt.')
+            exit(-1)
+        watch_results(args, formats)
+        exit(0)
+
     page_status = get_request_status(args.api_url, args.api_key, args.request_id)
 
-    os.makedirs(args.output_path, exist_ok=True)
+    # one session per thread, so the number of connections is bounded by number of threads
+    thread_local = threading.local()
 
-    session = requests.Session()
+    def download(page_name):
+        if not hasattr(thread_local, 'session'):
+            thread_local.session = requests.Session()
+        download_results(page_name, thread_local.session, args.api_url, args.api_key, args.request_id,
+                         args.output_path, args.alto, args.page, args.txt)
 
     state_counts = defaultdict(int)
-    for page_name in sorted(page_status):
-        if page_status[page_name]['state'] == 'PROCESSED':
-            print(page_name, page_status[page_name]['state'], page_status[page_name]['quality'])
-            download_results(page_name, session, args.api_url, args.api_key, args.request_id, args.output_path, args.alto, args.page, args.txt)
-        else:
-            print(page_name, page_status[page_name]['state'])
-
-        state_counts[page_status[page_name]['state']] += 1
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        downloads = []
+        for page_name in sorted(page_status):
+            if page_status[page_name]['state'] == 'PROCESSED':
+                print(page_name, page_status[page_name]['state'], page_status[page_name]['quality'])
+                downloads.append(executor.submit(download, page_name))
+            else:
+                print(page_name, page_status[page_name]['state'])
+
+            state_counts[page_status[page_name]['state']] += 1
+
+        for future in downloads:
+            future.result()
 
     print('SUMMARY:')
     for state in state_counts: